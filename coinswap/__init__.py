@@ -1,17 +1,33 @@
-from .state_machine import StateMachine
+from .state_machine import (StateMachine, StateLatencies, LatencyHistogram,
+                            get_state_latencies)
 from .base import (CoinSwapException, CoinSwapPublicParameters,
                       CoinSwapParticipant, CoinSwapTX, CoinSwapTX01,
                       CoinSwapTX23, CoinSwapTX45, CoinSwapRedeemTX23Secret,
                       CoinSwapRedeemTX23Timeout, COINSWAP_SECRET_ENTROPY_BYTES,
-                      get_coinswap_secret, get_current_blockheight,
-                      create_hash_script, get_secret_from_vin,
-                      generate_escrow_redeem_script, get_transactions_from_block,
+                      ESCROW_REDEEM_SCRIPT_PREFIX, get_coinswap_secret,
+                      get_current_blockheight, create_hash_script,
+                      get_secret_from_vin,
+                      generate_escrow_redeem_script,
                       prepare_ecdsa_msg, FeePolicy)
 from .configure import (cs_single, get_log, load_coinswap_config)
 from .cli_options import get_coinswap_parser
+from .blockcache import BlockCache, get_block_cache
+from .scanner import (SecretScanner, SecretScanCoordinator, SecretIndex,
+                      SecretIndexFollower, find_preimages_in_rawblock,
+                      find_outpoint_spender, get_secret_scan_coordinator)
+from .mempool import MempoolWatcher, get_mempool_watcher
+from .rtt import (RTTEstimator, RTTSampleFile, get_rtt_estimator,
+                  get_rtt_sample_file)
+from .addresspool import AddressPool, get_address_pool
+from .keypool import KeypairPool, get_keypair_pool
+from .notify import (ChainNotifyResource, ConfirmationNotifier,
+                     HeightScheduler, ChainTip, PollingPolicy, AdaptiveLoop,
+                     get_confirmation_notifier, get_height_scheduler,
+                     get_chain_tip, query_confirmations)
 from .alice import CoinSwapAlice
 from .carol import CoinSwapCarol
-from .csjson import CoinSwapCarolJSONServer, CoinSwapJSONRPCClient
+from .csjson import (CoinSwapCarolJSONServer, CoinSwapJSONRPCClient,
+                     SizeLimitedRequest)
 from .tor import start_tor
 
 
@@ -0,0 +1,75 @@
+from __future__ import print_function
+"""Wallet addresses derived (and imported into Bitcoin Core) in advance,
+so that sessions can take them without doing so while handling a request.
+"""
+
+from collections import deque
+from twisted.internet import reactor
+from .configure import get_log, cs_single
+
+cslog = get_log()
+
+class AddressPool(object):
+    """Pools of fresh addresses from wallet, one per (mixdepth, branch)
+    that has been asked for, each refilled up to size. Taking an address
+    is O(1) unless its pool is empty. Refilling is done on the reactor
+    thread, since the wallet is not thread safe, but one address per
+    reactor iteration, so it does not hold up requests. Addresses not
+    used (e.g. by a session backed out before any funds moved) can be
+    returned with release(), and are taken again first.
+    Unused pooled addresses are a gap in the wallet's branch, so size is
+    kept below the wallet's gap limit, and all of the server's addresses
+    on these branches must be taken from the pool, not derived directly.
+    """
+    def __init__(self, wallet, size):
+        self.wallet = wallet
+        if size >= wallet.gaplimit:
+            cslog.info("address_pool_size must be below the wallet gap "
+                       "limit (" + str(wallet.gaplimit) + "); using: " + str(
+                           wallet.gaplimit - 1))
+            size = wallet.gaplimit - 1
+        self.size = size
+        #(mixdepth, branch) : addresses
+        self.pools = {}
+        self.refill_scheduled = False
+
+    def fill(self, mixdepth, branch):
+        """Start keeping the pool for (mixdepth, branch) filled.
+        """
+        self.pools.setdefault((mixdepth, branch), deque())
+        self.schedule_refill()
+
+    def take(self, mixdepth, branch):
+        self.fill(mixdepth, branch)
+        pool = self.pools[(mixdepth, branch)]
+        if pool:
+            return pool.popleft()
+        cslog.info("Address pool empty for mixdepth, branch: " + str(
+            (mixdepth, branch)))
+        return self.wallet.get_new_addr(mixdepth, branch, True)
+
+    def release(self, mixdepth, branch, address):
+        self.pools.setdefault((mixdepth, branch), deque()).appendleft(address)
+
+    def schedule_refill(self):
+        if not self.refill_scheduled:
+            self.refill_scheduled = True
+            reactor.callLater(0, self.refill)
+
+    def refill(self):
+        self.refill_scheduled = False
+        for key in sorted(self.pools):
+            if len(self.pools[key]) < self.size:
+                self.pools[key].append(self.wallet.get_new_addr(key[0], key[1],
+                                                                True))
+                self.schedule_refill()
+                return
+
+def get_address_pool(wallet):
+    """The process-wide AddressPool, for wallet (there is one per
+    process), with the size set in the SERVER section of the config.
+    """
+    if not cs_single().address_pool:
+        cs_single().address_pool = AddressPool(wallet,
+            cs_single().config.getint("SERVER", "address_pool_size"))
+    return cs_single().address_pool
@@ -1,7 +1,7 @@
 from __future__ import print_function
 import jmbitcoin as btc
 from jmclient import estimate_tx_fee
-from twisted.internet import reactor, task
+from twisted.internet import reactor
 from .configure import get_log
 from decimal import Decimal
 import binascii
@@ -19,6 +19,7 @@ from .base import (CoinSwapException, CoinSwapPublicParameters,
                       get_coinswap_secret, get_current_blockheight,
                       create_hash_script, get_secret_from_vin,
                       generate_escrow_redeem_script, prepare_ecdsa_msg)
+from .rtt import get_rtt_estimator
 from coinswap import cs_single
 
 cslog = get_log()
@@ -46,11 +47,14 @@ class CoinSwapAlice(CoinSwapParticipant):
     State 13: Sent TX4 sig. (complete)
     ==================================================
     """
+    role = "Alice"
     required_key_names = ["key_2_2_AC_0", "key_2_2_CB_1",
                                 "key_TX2_lock", "key_TX3_secret", "key_session"]
 
     def set_jsonrpc_client(self, jsonrpcclient):
         self.jsonrpcclient = jsonrpcclient
+        self.sm.set_rtt_estimator(get_rtt_estimator(
+            jsonrpcclient.host + ":" + str(jsonrpcclient.port)))
     
     def get_state_machine_callbacks(self):
         return [(self.handshake, False, -1),
@@ -100,13 +104,14 @@ class CoinSwapAlice(CoinSwapParticipant):
         else:
             return self.jsonrpcclient.send("handshake", *params)
 
-    def send_poll(self, method, callback):
+    def send_poll(self, method, callback, *args):
         nonce = self.get_msg_nonce()
-        msg_to_sign = prepare_ecdsa_msg(nonce, method)
+        msg_to_sign = prepare_ecdsa_msg(nonce, method, *args)
         sig = btc.ecdsa_sign(msg_to_sign, self.keyset["key_session"][0])
         noncesig = {"nonce": nonce, "sig": sig}
         return self.jsonrpcclient.send_poll(method, callback, noncesig,
-                                            self.coinswap_parameters.session_id)
+                                            self.coinswap_parameters.session_id,
+                                            *args)
     def handshake(self):
         """Record the state of the wallet at the start of the process.
         Send a handshake message to Carol with required parameters for
@@ -323,33 +328,45 @@ class CoinSwapAlice(CoinSwapParticipant):
         return (True, "Pushed TX0 OK: " + self.tx0.txid)
 
     def see_tx0_tx1(self):
-        self.loop = task.LoopingCall(self.check_for_phase1_utxos,
-                                     [self.tx0.txid + ":" + str(
-                                         self.tx0.pay_out_index), self.txid1])
-        self.loop.start(3.0)
-        return (True, "Monitoring loop for TX0 started")
+        self.check_for_phase1_utxos([self.tx0.txid + ":" + str(
+            self.tx0.pay_out_index), self.txid1])
+        return (True, "Monitoring for TX0 started")
 
     def wait_for_phase_2(self):
         """This is fired when both TX0 and TX1 are seen confirmed.
         But, we do not continue until the other side returns positive from
         the rpc call phase2_ready, i.e. they confirm they see them also. 
         """
-        self.phase2_loop = task.LoopingCall(self.send_poll, "phase2_ready",
-                                            self.phase2_callback)
-        self.phase2_loop.start(3.0)
-        return (True, "Wait for phase2 loop started")
+        self.phase2_waiting = True
+        self.poll_phase2()
+        return (True, "Wait for phase2 started")
+
+    def poll_phase2(self):
+        if not self.phase2_waiting or self.sm.freeze:
+            return
+        self.phase2_poll_sent = time.time()
+        self.send_poll("phase2_ready", self.phase2_callback,
+                       self.get_long_poll_timeout())
+
+    def get_long_poll_timeout(self):
+        return cs_single().config.getint("TIMEOUT", "long_poll_timeout")
 
     def phase2_callback(self, result):
         """Proceeds to next state when Carol confirms
-        that TX0 and TX1 are confirmed.
+        that TX0 and TX1 are confirmed. Carol holds each request
+        until then or until the long poll times out, in which case
+        we ask again, but no sooner than poll_interval_min after the last
+        request (in case the server does not hold requests for long).
         """
-        if not self.phase2_loop.running:
-            #can occur if response from other end is slow
+        if not self.phase2_waiting or self.sm.freeze:
             return
         if not result:
+            min_interval = cs_single().config.getfloat("TIMEOUT",
+                                                       "poll_interval_min")
+            elapsed = time.time() - self.phase2_poll_sent
+            reactor.callLater(max(min_interval - elapsed, 0), self.poll_phase2)
             return
-        if self.phase2_loop.running:
-            self.phase2_loop.stop()
+        self.phase2_waiting = False
         self.sm.tick()
         
     def send_coinswap_secret(self):
@@ -387,23 +404,10 @@ class CoinSwapAlice(CoinSwapParticipant):
         errmsg, success = self.tx5.push()
         if not success:
             return (False, "Failed to push TX5, errmsg: " + errmsg)
-        self.loop_tx5 = task.LoopingCall(self.wait_for_tx5_confirmation)
-        self.loop_tx5.start(3.0)
+        #wait for TX5 on network before TX4.
+        self.wait_for_confirmations([self.tx5.txid + ":0"], 1, self.sm.tick)
         return (True, "TX5 broadcast OK")
 
-    def wait_for_tx5_confirmation(self, confs=1):
-        """Looping task to wait for TX5 on network before TX4.
-        """
-        result = cs_single().bc_interface.query_utxo_set([self.tx5.txid+":0"],
-                                                         includeconf=True)
-        if None in result:
-            return
-        for u in result:
-            if u['confirms'] < confs:
-                return
-        self.loop_tx5.stop()
-        self.sm.tick()
-
     def send_tx4_sig(self):
         """Send partial signature on TX4 (out of TX0)
         to Carol for her to complete sign and broadcast.
@@ -419,32 +423,22 @@ class CoinSwapAlice(CoinSwapParticipant):
         self.tx4.sign_at_index(self.keyset["key_2_2_AC_0"][0], 0)
         sig = self.tx4.signatures[0][0]
         self.send(sig, self.tx5.txid)
-        self.tx4broadcast_counter = 0
-        self.loop_tx4 = task.LoopingCall(self.wait_for_tx4_confirmation)
-        self.loop_tx4.start(3.0)
+        #Carol's confirmation that TX4 is seen on network is used to
+        #trigger finalization of run. This is only a 'courtesy', since it
+        #has no effect on us, so we only wait for one long poll.
+        self.send_poll("confirm_tx4", self.tx4_callback,
+                       self.get_long_poll_timeout())
         return (True, "TX4 signature sent.")
 
-    def wait_for_tx4_confirmation(self):
-        """Receives notification from Carol that tx4 is seen on network;
-        we use it to trigger finalization of run. This is only a 'courtesy',
-        since it has no effect on us, so we don't wait forever.
-        """
-        self.tx4broadcast_counter += 1
-        if self.tx4broadcast_counter > 10:
-            cslog.info("Timed out waiting for Carol to confirm broadcast "
-                      "of TX4; this has no effect on us, so we give up.")
-            self.tx4_callback("None")
-            return
-        self.send_poll("confirm_tx4", self.tx4_callback)
-    
     def tx4_callback(self, result):
         """Once Carol has confirmed receipt of TX4, retrieve
         txid for our records, and finish the Coinswap protocol.
         """
         if not result:
-            return
+            cslog.info("Timed out waiting for Carol to confirm broadcast "
+                      "of TX4; this has no effect on us, so we give up.")
+            result = "None"
         self.txid4 = result
-        self.loop_tx4.stop()
         self.quit()
 
     def check_server_status(self, status):
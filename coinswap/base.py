@@ -1,14 +1,19 @@
 from __future__ import print_function
 import jmbitcoin as btc
 from jmclient import (Wallet, get_p2pk_vbyte, get_p2sh_vbyte, estimate_tx_fee)
-from twisted.internet import reactor, task
+from twisted.internet import reactor
 from txjsonrpc.web.jsonrpc import Proxy
 from txjsonrpc.web import jsonrpc
 from twisted.web import server
 from .configure import get_log, cs_single
-from .state_machine import StateMachine
+from .state_machine import StateMachine, get_state_latencies
+from .keypool import generate_privkey, generate_keypair
+from .addresspool import get_address_pool
+from .notify import (get_confirmation_notifier, get_height_scheduler,
+                     get_chain_tip, AdaptiveLoop)
 from decimal import Decimal
 import binascii
+import struct
 import time
 import os
 import random
@@ -43,11 +48,11 @@ def _byteify(data, ignore_dicts = False):
     return data
 
 def get_current_blockheight():
-    """returns current blockheight as integer.
+    """returns current blockheight as integer, from the cached
+    chain tip (see notify.ChainTip).
     Assumes existence of valid Core blockchain interface instance.
     """
-    blockchainInfo = cs_single().bc_interface.jsonRpc.call("getblockchaininfo", [])
-    return blockchainInfo["blocks"]
+    return get_chain_tip().height
 
 def int_to_tx_ser(x):
     """Given an integer, return the correct byte-serialization
@@ -59,37 +64,61 @@ def int_to_tx_ser(x):
     h = h[::-1]
     return h
 
-def read_length(x):
-    bx = binascii.unhexlify(x)
-    val = ord(bx[0])
+def read_varint(data, offset):
+    """Reads a Bitcoin variable length integer from the binary
+    string data, starting at offset; returns the value and the
+    offset of the first byte after it.
+    """
+    val = struct.unpack_from("<B", data, offset)[0]
     if val < 253:
-        n = 1
+        return (val, offset + 1)
     elif val == 253:
-        val = btc.decode(bx[1:3][::-1], 256)
-        n = 3
+        return (struct.unpack_from("<H", data, offset + 1)[0], offset + 3)
     elif val == 254:
-        val = btc.decode(bx[1:5][::-1], 256)
-        n = 5
-    elif val == 255:
-        val = btc.decode(bx[1:9][::-1], 256)
-        n = 9
-    else:
-        assert False
-    return (val, n)
-
-def get_transactions_from_block(blockheight):
-    block = cs_single().bc_interface.get_block(blockheight)
-    txdata = block[160:]
-    ntx, nbytes = read_length(txdata)
-    txdata = txdata[nbytes*2:]
-    found_txs = []
-    for i in range(ntx):
-        tx = btc.deserialize(txdata)
-        if i != 0:
-            found_txs.append(tx)
-        len_tx = len(btc.serialize(tx))
-        txdata = txdata[len_tx:]
-    return found_txs
+        return (struct.unpack_from("<I", data, offset + 1)[0], offset + 5)
+    return (struct.unpack_from("<Q", data, offset + 1)[0], offset + 9)
+
+def get_tx_end(data, offset):
+    """Given binary block data and the offset of the start of a
+    serialized transaction within it, return the offset of the end of
+    that transaction. The structure is only walked, not copied or
+    deserialized, so the cost is proportional to the number of inputs
+    and outputs, not to the size of the block.
+    """
+    pos = offset + 4
+    #a zero byte where the input count should be is the segwit marker
+    segwit = data[pos] == "\x00"
+    if segwit:
+        pos += 2
+    nins, pos = read_varint(data, pos)
+    for _ in range(nins):
+        #outpoint (36 bytes), scriptSig, sequence (4 bytes)
+        scriptlen, pos = read_varint(data, pos + 36)
+        pos += scriptlen + 4
+    nouts, pos = read_varint(data, pos)
+    for _ in range(nouts):
+        #amount (8 bytes), scriptPubKey
+        scriptlen, pos = read_varint(data, pos + 8)
+        pos += scriptlen
+    if segwit:
+        for _ in range(nins):
+            nitems, pos = read_varint(data, pos)
+            for _ in range(nitems):
+                itemlen, pos = read_varint(data, pos)
+                pos += itemlen
+    #locktime
+    return pos + 4
+
+def iter_block_tx_offsets(rawblock):
+    """Yields (start, end) offsets of each serialized transaction
+    in the binary block rawblock, in block order (coinbase first).
+    """
+    #skip the 80 byte header
+    ntx, pos = read_varint(rawblock, 80)
+    for _ in range(ntx):
+        end = get_tx_end(rawblock, pos)
+        yield (pos, end)
+        pos = end
 
 def msig_data_from_pubkeys(pubkeys, N):
     """Create a p2sh address for the list of pubkeys given, N signers required.
@@ -123,6 +152,10 @@ def get_secret_from_vin(vins, hashed_secret):
         scriptsig_serialized = vin["script"]
         #a match will start with (signature, secret, ...) so match only pos 1
         ss_deserialized = btc.deserialize_script(scriptsig_serialized)
+        #segwit and other inputs may not have two pushes
+        if len(ss_deserialized) < 2 or not isinstance(ss_deserialized[1],
+                                                      basestring):
+            continue
         if len(ss_deserialized[1]) != 2*COINSWAP_SECRET_ENTROPY_BYTES:
             continue
         candidate_secret = get_coinswap_secret(raw_secret=ss_deserialized[1])
@@ -145,6 +178,11 @@ def create_hash_script(redeemer_pubkey, hashes):
     script += [redeemer_pubkey, btc.OP_CHECKSIG]
     return script
 
+#The fixed start of every escrow redeem script (see below), up to
+#the push of the hashed secret.
+ESCROW_REDEEM_SCRIPT_PREFIX = "".join([chr(x) for x in [btc.OP_DEPTH,
+                    btc.OP_2, btc.OP_EQUAL, btc.OP_IF, btc.OP_HASH160, 20]])
+
 def generate_escrow_redeem_script(hashed_secret, recipient_pubkey, locktime,
                             refund_pubkey):
     """Generate an output script and address that pays either to the
@@ -707,6 +745,8 @@ class CoinSwapRedeemTX23Timeout(CoinSwapTX):
 
 class CoinSwapParticipant(object):
     __metaclass__ = abc.ABCMeta
+    #"Alice" or "Carol"; state latencies are aggregated by role
+    role = None
 
     def __init__(self, wallet, state_file, cpp=None, testing_mode=False,
                  fee_checker=None):
@@ -736,6 +776,9 @@ class CoinSwapParticipant(object):
         self.txid5 = None
         self.secret = None
         self.hashed_secret = None
+        #Only used by Carol; [lowest, highest] block heights already scanned
+        #for the secret, so a retried or restarted scan can skip them.
+        self.secret_scan_covered = None
         #Created on the fly for redeeming a backout (same mixdepth as origin)
         self.backout_redeem_addr = None
         #Only used by Alice; fee check callback
@@ -750,12 +793,21 @@ class CoinSwapParticipant(object):
         #currently only used by Carol; TODO
         self.phase2_ready = False
         self.tx4_confirmed = False
+        #[condition, deferred, timeout call] for each long-poll request held
+        self.long_polls = []
         self.successful_tx3_redeem = None
         self.consumed_nonces = []
         #Allows owner to stop tracking.
         self.completed = False
+        #Called, if set, when completed is set (used by the server to
+        #update its status).
+        self.completion_callback = None
         #Keep track of when blocks arrive for better logging.
         self.last_seen_block = None
+        #(scheduler id, message) while backout waits for a block height
+        self.backout_wakeup = None
+        #ConfirmationNotifier ids of the confirmations waited for
+        self.confirmation_waits = set()
         #Carol must keep track of coins reserved for usage
         #so as to not select them to spend, twice, concurrently.
         #We only init with a fresh empty list if this is the first
@@ -766,7 +818,8 @@ class CoinSwapParticipant(object):
         self.sm = StateMachine(self.state, self.backout,
                                self.get_state_machine_callbacks(),
                                float(cs_single().config.get("TIMEOUT",
-                                                      "default_network_timeout")))
+                                                      "default_network_timeout")),
+                               role=self.role)
         self.sm.set_finalize(self.finalize)
 
     def import_address(self, address):
@@ -802,8 +855,7 @@ class CoinSwapParticipant(object):
                  [tx.output_address,"joinmarket-notify",False])
 
     def generate_privkey(self):
-        #always hex, with compressed flag
-        return binascii.hexlify(os.urandom(32))+"01"
+        return generate_privkey()
 
     def finalize(self):
         self.persist()
@@ -823,6 +875,8 @@ class CoinSwapParticipant(object):
         self.keyset = loaded_state['keyset']
         self.secret = loaded_state['coinswap_secret_data']['preimage']
         self.hashed_secret = loaded_state['coinswap_secret_data']['hash']
+        self.secret_scan_covered = loaded_state['coinswap_secret_data'].get(
+            'scanned')
         #TODO: this less repetitive version doesn't work for some reason
         """
         for n, t, tt in zip(("TX0", "TX1", "TX2", "TX3", "TX4", "TX5"),
@@ -859,8 +913,10 @@ class CoinSwapParticipant(object):
         persisted_state['public_parameters'] = self.coinswap_parameters.serialize()
         persisted_state['current_state'] = self.sm.state
         persisted_state['keyset'] = self.keyset
-        persisted_state['coinswap_secret_data'] = {'hash': self.hashed_secret,
-                                                   'preimage': self.secret}
+        persisted_state['coinswap_secret_data'] = {
+            'hash': self.hashed_secret, 'preimage': self.secret,
+            'scanned': self.secret_scan_covered}
+        persisted_state['trace'] = self.sm.get_trace()
         for k, tx in {"TX0": self.tx0,
                       "TX1": self.tx1,
                       "TX2": self.tx2,
@@ -880,6 +936,9 @@ class CoinSwapParticipant(object):
     def quit(self, complete=True, failed=False):
         """A generic end-processing function.
         """
+        self.sm.cancel_stall_monitor()
+        self.cancel_confirmation_waits()
+        self.cancel_backout_wakeup()
         #A small delay to account for updates to the mempool.
         reactor.callLater(1.0, self.final_report, complete, failed)
 
@@ -892,6 +951,8 @@ class CoinSwapParticipant(object):
         (Alice, Carol) is running in this executable. This
         point is relevant for testing only currently.
         """
+        #the protocol will not continue, whatever confirms
+        self.cancel_confirmation_waits()
         if verbose:
             cslog.info('BACKOUT: ' + backoutmsg)
             me = "Alice" if isinstance(self, CoinSwapAlice) else "Carol"
@@ -916,6 +977,8 @@ class CoinSwapParticipant(object):
             x for x in self.wallet.used_coins if x not in self.tx1.utxo_ins]
                 cslog.info("We unlocked those for this run, it is now: " + \
                            str(self.wallet.used_coins))
+            if isinstance(self, CoinSwapCarol):
+                self.release_addresses()
             self.quit(False, False)
             return
         #Handling for later states depends on Alice/Carol
@@ -935,7 +998,9 @@ class CoinSwapParticipant(object):
                         self.coinswap_parameters.timeouts["LOCK0"] + 1) + \
                         ", current block: " + str(bh))
                         self.last_seen_block = bh
-                    reactor.callLater(3.0, self.backout, backoutmsg, False)
+                    self.wait_for_height(
+                        self.coinswap_parameters.timeouts["LOCK0"] + 1,
+                        backoutmsg)
                     return
                 msg, success = self.tx2.push()
                 if not success:
@@ -1017,9 +1082,11 @@ class CoinSwapParticipant(object):
             else:
                 assert False
         elif isinstance(self, CoinSwapCarol):
-            #for redeeming, we get a new address on the fly (not pre-agreed)
+            #for redeeming, we get a new address on the fly (not pre-agreed);
+            #from the pool, which derives the server's addresses on this branch.
             if not self.backout_redeem_addr:
-                self.backout_redeem_addr = self.wallet.get_new_addr(0, 1, True)
+                self.backout_redeem_addr = get_address_pool(self.wallet).take(
+                    0, 1)
             if self.sm.state in [6, 7]:
                 #This is by far the trickiest case.
                 #
@@ -1045,15 +1112,21 @@ class CoinSwapParticipant(object):
                 #7. Broadcast a spend-out using the secret branch for TX2.
                 #Note, all this has to happen a reasonable safety buffer before
                 #LOCK0.
+                #Before LOCK1 only Alice can spend TX3 (revealing the secret),
+                #so if we see that in the mempool we redeem TX2 immediately.
+                self.watch_mempool_for_tx3_spend()
                 bh = get_current_blockheight()
-                if bh < self.coinswap_parameters.timeouts["LOCK1"] + 1:
+                if bh < self.coinswap_parameters.timeouts["LOCK1"] + 1 and \
+                   not self.tx3.is_spent:
                     if not self.last_seen_block or bh > self.last_seen_block:
                         cslog.info("Not ready to redeem the funds, waiting for "
                         "block: " + str(
                         self.coinswap_parameters.timeouts["LOCK1"] + 1) + \
                         ", current block: " + str(bh))
                         self.last_seen_block = bh
-                    reactor.callLater(3.0, self.backout, backoutmsg, False)
+                    self.wait_for_height(
+                        self.coinswap_parameters.timeouts["LOCK1"] + 1,
+                        backoutmsg)
                     return
                 if bh > self.coinswap_parameters.timeouts["LOCK0"]:
                     cslog.info("CRITICAL WARNING: Too late, counterparty may "
@@ -1063,26 +1136,15 @@ class CoinSwapParticipant(object):
                 cslog.info("Monitor records is_spent: " + str(self.tx3.is_spent))
                 cslog.info("Monitor records is_broadcast: " + str(self.tx3.is_broadcast))
                 cslog.info("Monitor records is_confirmed: " + str(self.tx3.is_confirmed))
-                if not self.tx3.is_broadcast:
+                if not self.tx3.is_broadcast and not self.tx3.is_spent:
                     msg, success = self.tx3.push()
                     if not success:
                         #Failure to broadcast TX3 may be because it's already
                         #been broadcast and redeemed. Try scanning the blockchain
                         #to find the secret.
-                        scan_success = self.scan_blockchain_for_secret()
-                        if scan_success:
-                            rt2s_success = self.redeem_tx2_with_secret()
-                            self.quit(False, not rt2s_success)
-                            return
-                        #TODO: corner case: TX3 broadcast, but for some reason
-                        #not recorded as broadcast (restart), but not redeemed.
-                        cslog.info("Failed to broadcast TX3, "
-                                  "RPC error message: " + msg)
-                        cslog.info("Failed to broadcast TX3; here is raw form: ")
-                        cslog.info(self.tx3.fully_signed_tx)
-                        cslog.info("Readable form: ")
-                        cslog.info(self.tx3)
-                        return self.quit(False, True)
+                        d = self.scan_blockchain_for_secret()
+                        d.addCallback(self.redeem_tx2_after_scan, msg)
+                        return
                 if self.tx3.is_spent:
                     cslog.info("Detected TX3 already spent by Alice. "
                               "Extracting secret and then redeeming TX2.")
@@ -1108,9 +1170,10 @@ class CoinSwapParticipant(object):
                     #Fire a waiting loop that triggers on one of 2 events: (1)
                     #confirmation of tx3 redeem, or (2) consumption of tx3 outpoint
                     #without (1) occurring, and take action.
-                    self.carol_watcher_loop = task.LoopingCall(
-                        self.watch_for_tx3_spends, self.tx3redeem.txid)
-                    self.carol_watcher_loop.start(3.0)
+                    self.carol_watcher_loop = AdaptiveLoop(
+                        self.watch_for_tx3_spends, (self.tx3redeem.txid,),
+                        time_left=self.get_time_to_lock0, follow_tip=True)
+                    self.carol_watcher_loop.start()
             elif self.sm.state == 8:
                 #Alice did not provide TX4 sig but we already allowed
                 #TX5 spend; we use X to redeem from TX2, before L0.
@@ -1145,34 +1208,69 @@ class CoinSwapParticipant(object):
         """Any participant needs to wait for completion of phase 1 through
         seeing the utxos on the network. Optionally pass callback for start
         of phase2 (redemption phase), else default is state machine tick();
-        must have signature callback(utxolist).
+        must have signature callback().
         Triggered on number of confirmations as set by config.
-        This should be fired by task looptask, which is stopped on success.
         """
-        result = cs_single().bc_interface.query_utxo_set(utxos,
-                                                         includeconf=True)
-        if None in result:
+        self.wait_for_confirmations(utxos,
+                                    self.coinswap_parameters.tx01_confirm_wait,
+                                    cb if cb else self.sm.tick)
+
+    def wait_for_height(self, height, backoutmsg):
+        """Re-run backout once the chain reaches height (e.g. a locktime);
+        see notify.HeightScheduler.
+        """
+        if self.backout_wakeup:
             return
-        for u in result:
-            if u['confirms'] < self.coinswap_parameters.tx01_confirm_wait:
-                return
-        self.loop.stop()
-        if cb:
-            cb()
-        else:
-            self.sm.tick()
+        self.backout_wakeup = (get_height_scheduler().call_at_height(
+            height, self.wake_backout, backoutmsg), backoutmsg)
+
+    def wake_backout(self, backoutmsg):
+        self.backout_wakeup = None
+        self.backout(backoutmsg, False)
+
+    def wake_backout_now(self):
+        """If backout is waiting for a block height, run it immediately
+        (used when an event makes the wait unnecessary).
+        """
+        if self.backout_wakeup:
+            backoutmsg = self.backout_wakeup[1]
+            self.cancel_backout_wakeup()
+            self.wake_backout(backoutmsg)
+
+    def cancel_backout_wakeup(self):
+        if self.backout_wakeup:
+            get_height_scheduler().cancel(self.backout_wakeup[0])
+            self.backout_wakeup = None
+
+    def wait_for_confirmations(self, utxos, confirms, callback):
+        """Calls callback() once, when all of utxos have at least confirms
+        confirmations; see notify.ConfirmationNotifier. The wait is
+        cancelled if the session backs out or quits first.
+        """
+        def confirmed():
+            self.confirmation_waits.discard(waiter_id)
+            callback()
+        waiter_id = get_confirmation_notifier().register(utxos, confirms,
+                                                         confirmed)
+        self.confirmation_waits.add(waiter_id)
+
+    def cancel_confirmation_waits(self):
+        for waiter_id in self.confirmation_waits:
+            get_confirmation_notifier().cancel(waiter_id)
+        self.confirmation_waits = set()
 
     def generate_keys(self):
         """These are ephemeral keys required for redeeming various transactions.
         (Ephemeral in the sense that they must *not* be used for different runs,
         but must of course be persisted for the run).
+        They are taken from the keypair pool if it has been started (by the
+        server), so no EC multiplication is done here.
         """
-        self.keyset_keys = [self.generate_privkey() for _ in range(
+        pool = cs_single().keypair_pool
+        keypairs = [pool.take() if pool else generate_keypair() for _ in range(
             len(self.required_key_names))]
-        self.keyset = {}
-        for i, name in enumerate(self.required_key_names):
-            self.keyset[name] = (self.keyset_keys[i],
-                                 btc.privkey_to_pubkey(self.keyset_keys[i]))
+        self.keyset_keys = [k[0] for k in keypairs]
+        self.keyset = dict(zip(self.required_key_names, keypairs))
         #keys will be stored on first persist, after parameters negotiated.
 
     def final_report(self, complete=True, failed=False):
@@ -1184,6 +1282,8 @@ class CoinSwapParticipant(object):
         from .carol import CoinSwapCarol
         self.completed = True
         sync_wallet(self.wallet, fast=True)
+        if self.completion_callback:
+            self.completion_callback()
         self.bbma = self.wallet.get_balance_by_mixdepth(verbose=False)
         cslog.info("Wallet before: ")
         cslog.info(pformat(self.bbmb))
@@ -1225,6 +1325,9 @@ class CoinSwapParticipant(object):
                     report_msg += ["Amount: " + str(t.output_amount)]
                     report_msg += ["To address: " + t.output_address]
 
+        report_msg.append("**************")
+        report_msg.append("State latencies for all sessions as " + self.role + ":")
+        report_msg += get_state_latencies(self.role).summary()
         cslog.info("\n" + "\n".join(report_msg))
 
         if isinstance(self, CoinSwapCarol) and failed == True:
@@ -0,0 +1,194 @@
+from __future__ import print_function
+"""A cache of raw blocks, shared by everything in the process that reads
+blocks from Bitcoin Core (secret scans, the secret index, backouts), so
+that overlapping scans and retries do not fetch the same block twice.
+"""
+
+import binascii
+import os
+import threading
+from collections import OrderedDict
+from .configure import get_log, cs_single
+
+cslog = get_log()
+
+class BlockCache(object):
+    """An LRU cache of binary serialized blocks keyed by block hash,
+    bounded by the total size of the blocks held, not their number.
+    Since a block hash commits to the block's contents, these entries
+    never become invalid; only the separately cached height : hash
+    mapping can be changed by a reorg, and it is checked against the
+    chain tip (see sync_tip) and against each new block's parent.
+    If spill_dir is set, every block fetched is also written there,
+    bounded by spill_max_bytes, so a restarted server (e.g. backing out
+    after a crash) need not fetch the blocks again.
+    All methods are thread safe; RPC calls are made with the connection
+    object passed in, outside the lock.
+    """
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir if spill_max_bytes > 0 else None
+        self.spill_max_bytes = spill_max_bytes
+        if self.spill_dir and not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        #block hash : binary block, least recently used first
+        self.blocks = OrderedDict()
+        self.size = 0
+        #height : block hash
+        self.heights = {}
+        #the (height, hash) of the tip when the heights were last checked
+        self.tip = None
+        self.lock = threading.Lock()
+
+    def get_block_hash(self, height, rpc):
+        with self.lock:
+            blockhash = self.heights.get(height)
+        if not blockhash:
+            blockhash = str(rpc.call("getblockhash", [height]))
+            with self.lock:
+                self.heights[height] = blockhash
+        return blockhash
+
+    def get_rawblock(self, height, rpc):
+        """Returns the binary serialized block at height.
+        """
+        blockhash = self.get_block_hash(height, rpc)
+        rawblock = self.get_rawblock_by_hash(blockhash, rpc)
+        self.check_parent(height, rawblock)
+        return rawblock
+
+    def get_rawblock_by_hash(self, blockhash, rpc):
+        with self.lock:
+            rawblock = self.blocks.pop(blockhash, None)
+            if rawblock is not None:
+                self.blocks[blockhash] = rawblock
+                return rawblock
+        rawblock = self.read_spilled(blockhash)
+        if rawblock is None:
+            rawblock = binascii.unhexlify(rpc.call("getblock",
+                                                   [blockhash, False]))
+            self.spill(blockhash, rawblock)
+        self.add(blockhash, rawblock)
+        return rawblock
+
+    def add(self, blockhash, rawblock):
+        if len(rawblock) > self.max_bytes:
+            return
+        with self.lock:
+            if blockhash in self.blocks:
+                return
+            self.blocks[blockhash] = rawblock
+            self.size += len(rawblock)
+            while self.size > self.max_bytes:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def check_parent(self, height, rawblock):
+        """If the cached hash for the previous height is not this block's
+        parent, a reorg has happened since it was cached; drop it and
+        everything below it that may also have been replaced.
+        """
+        prevhash = binascii.hexlify(rawblock[4:36][::-1])
+        with self.lock:
+            cached = self.heights.get(height - 1)
+            if cached and cached != prevhash:
+                cslog.info("Block cache detected reorg below height: " + str(
+                    height))
+                self.heights = dict([(h, v) for h, v in self.heights.iteritems(
+                    ) if h >= height])
+                self.heights[height - 1] = prevhash
+
+    def sync_tip(self, rpc):
+        """Check the cached heights against the current chain; any
+        heights no longer in the best chain are forgotten. Costs one
+        call if the tip has not changed, otherwise one per reorged block.
+        """
+        tiphash = str(rpc.call("getbestblockhash", []))
+        with self.lock:
+            if self.tip and self.tip[1] == tiphash:
+                return
+        tipheight = rpc.call("getblockcount", [])
+        with self.lock:
+            for h in [h for h in self.heights if h > tipheight]:
+                del self.heights[h]
+            self.heights[tipheight] = tiphash
+            oldtip = self.tip
+        if oldtip:
+            #walk back from below the new tip until the cached hash agrees
+            h = min(oldtip[0], tipheight - 1)
+            while h >= 0:
+                with self.lock:
+                    cached = self.heights.get(h)
+                if not cached:
+                    break
+                if cached == str(rpc.call("getblockhash", [h])):
+                    break
+                cslog.info("Block cache dropping reorged height: " + str(h))
+                with self.lock:
+                    self.heights.pop(h, None)
+                h -= 1
+        with self.lock:
+            self.tip = (tipheight, tiphash)
+
+    def invalidate_from(self, height):
+        """Forget the block hashes at height and above.
+        """
+        with self.lock:
+            for h in [h for h in self.heights if h >= height]:
+                del self.heights[h]
+            self.tip = None
+
+    def spill_path(self, blockhash):
+        return os.path.join(self.spill_dir, blockhash)
+
+    def read_spilled(self, blockhash):
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self.spill_path(blockhash), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def spill(self, blockhash, rawblock):
+        if not self.spill_dir:
+            return
+        try:
+            with open(self.spill_path(blockhash) + ".tmp", "wb") as f:
+                f.write(rawblock)
+            os.rename(self.spill_path(blockhash) + ".tmp",
+                      self.spill_path(blockhash))
+            self.trim_spill()
+        except (IOError, OSError) as e:
+            cslog.info("Failed to write block to disk cache: " + repr(e))
+
+    def trim_spill(self):
+        """Remove the oldest spilled blocks beyond spill_max_bytes.
+        """
+        with self.lock:
+            files = []
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                if name.endswith(".tmp"):
+                    continue
+                st = os.stat(path)
+                files.append((st.st_mtime, st.st_size, path))
+            total = sum([f[1] for f in files])
+            for mtime, size, path in sorted(files):
+                if total <= self.spill_max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+
+def get_block_cache():
+    """The process-wide BlockCache, created on first use with the sizes
+    set in the SERVER section of the config.
+    """
+    if not cs_single().block_cache:
+        c = cs_single().config
+        spill_mb = c.getint("SERVER", "block_cache_disk_mb")
+        cs_single().block_cache = BlockCache(
+            c.getint("SERVER", "block_cache_mb") * 1000000,
+            os.path.join(cs_single().homedir, "blockcache"),
+            spill_mb * 1000000)
+    return cs_single().block_cache
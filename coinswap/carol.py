@@ -1,7 +1,7 @@
 from __future__ import print_function
 import jmbitcoin as btc
 from jmclient import estimate_tx_fee
-from twisted.internet import reactor, task
+from twisted.internet import reactor, threads, defer
 from txjsonrpc.web.jsonrpc import Proxy
 from txjsonrpc.web import jsonrpc
 from twisted.web import server
@@ -21,11 +21,18 @@ from coinswap import (CoinSwapException, CoinSwapPublicParameters,
                       CoinSwapRedeemTX23Timeout, COINSWAP_SECRET_ENTROPY_BYTES,
                       get_coinswap_secret, get_current_blockheight,
                       create_hash_script, get_secret_from_vin,
-                      generate_escrow_redeem_script, cs_single,
-                      get_transactions_from_block)
+                      generate_escrow_redeem_script, cs_single)
+from .scanner import get_secret_scan_coordinator, find_outpoint_spender
+from .mempool import get_mempool_watcher
+from .addresspool import get_address_pool
+from .notify import get_chain_tip
 
 cslog = get_log()
 
+#The client's locktimes are checked against a chain tip read at most
+#this many seconds before, rather than the tip as last polled.
+LOCKTIME_CHECK_TIP_MAX_AGE = 5
+
 class CoinSwapCarol(CoinSwapParticipant):
     """
     State machine:
@@ -46,9 +53,54 @@ class CoinSwapCarol(CoinSwapParticipant):
     State 10: TX4 broadcast.
     ==================================================
     """
+    role = "Carol"
+    #The (mixdepth, branch) of each of Carol's destination addresses:
+    #TX4 output is the normal coinswap output, not combined with original.
+    #TX5 output address functions like change, goes back to original.
+    #TX2/3 are unambiguous coinswap outs, since adversary can deduce
+    #who they belong to, no point in isolating them (go back to start).
+    destination_branches = {"tx4_address": (1, 1),
+                            "tx2_carol_address": (0, 1),
+                            "tx3_carol_address": (0, 1),
+                            "tx5_carol_address": (0, 1)}
     required_key_names = ["key_2_2_AC_1", "key_2_2_CB_0",
                                   "key_TX2_secret", "key_TX3_lock"]
 
+    def reserve_addresses(self):
+        """Take this session's destination addresses from the address
+        pool; done only once Alice's parameters have been accepted, so that
+        abandoned handshakes do not use up wallet addresses.
+        """
+        pool = get_address_pool(self.wallet)
+        addresses = dict([(k, pool.take(*v)) for k, v in
+                          self.destination_branches.iteritems()])
+        self.coinswap_parameters.set_addr_data(
+            addr4=addresses["tx4_address"],
+            addr_2_carol=addresses["tx2_carol_address"],
+            addr_3_carol=addresses["tx3_carol_address"],
+            addr_5_carol=addresses["tx5_carol_address"])
+
+    def release_addresses(self):
+        """Return this session's destination addresses to the address
+        pool, so they are not burned, when backing out before any funds
+        have moved. From state 3 on, Carol has signed TX2, which pays to
+        tx2_carol_address and which Alice may broadcast; reusing any of
+        them for another session could link the two on-chain, so they are
+        discarded instead.
+        """
+        if self.sm.state >= 3:
+            cslog.info("Not reusing the addresses of this session, since "
+                       "TX2 has been signed.")
+            return
+        pool = get_address_pool(self.wallet)
+        for k, (mixdepth, branch) in self.destination_branches.iteritems():
+            address = self.coinswap_parameters.output_addresses.get(k)
+            if address:
+                pool.release(mixdepth, branch, address)
+        self.coinswap_parameters.output_addresses = dict([(k, v) for k, v in
+            self.coinswap_parameters.output_addresses.iteritems() if
+            k not in self.destination_branches])
+
     def consume_nonce(self, nonce):
         """Keep track of nonces for this session to prevent
         a replay attack.
@@ -81,8 +133,8 @@ class CoinSwapCarol(CoinSwapParticipant):
     def jsonrpc_sigtx3(self, sig):
         return self.sm.tick(sig)
 
-    def jsonrpc_phase2_ready(self):
-        return self.is_phase2_ready()
+    def jsonrpc_phase2_ready(self, timeout=0):
+        return self.long_poll(self.is_phase2_ready, timeout)
 
     def jsonrpc_secret(self, secret):
         return self.sm.tick(secret)
@@ -90,8 +142,55 @@ class CoinSwapCarol(CoinSwapParticipant):
     def jsonrpc_sigtx4(self, sig, txid5):
         return self.sm.tick(sig, txid5)
 
-    def jsonrpc_confirm_tx4(self):
-        return self.is_tx4_confirmed()
+    def jsonrpc_confirm_tx4(self, timeout=0):
+        return self.long_poll(self.is_tx4_confirmed, timeout)
+
+    def long_poll(self, condition, timeout):
+        """For stateless polling requests: if condition() is already true,
+        or no timeout is requested, return its value now; otherwise return
+        a Deferred firing with its value when it becomes true (see
+        update_long_polls), after timeout seconds, or when the session
+        ends (see finish_long_polls), whichever is first.
+        The timeout is capped by our own long_poll_timeout. Cancelling
+        the Deferred (done by the server if the client disconnects)
+        drops the poll.
+        """
+        value = condition()
+        if value or not timeout or timeout <= 0:
+            return value
+        timeout = min(float(timeout), cs_single().config.getint(
+            "TIMEOUT", "long_poll_timeout"))
+        poll = [condition, None, None]
+        poll[1] = defer.Deferred(lambda d: self.drop_long_poll(poll))
+        poll[2] = reactor.callLater(timeout, self.end_long_poll, poll)
+        self.long_polls.append(poll)
+        return poll[1]
+
+    def drop_long_poll(self, poll):
+        if poll in self.long_polls:
+            self.long_polls.remove(poll)
+        if poll[2].active():
+            poll[2].cancel()
+
+    def end_long_poll(self, poll):
+        if poll not in self.long_polls:
+            return
+        self.drop_long_poll(poll)
+        poll[1].callback(poll[0]())
+
+    def update_long_polls(self):
+        """Answer any held requests whose condition is now true.
+        """
+        for poll in self.long_polls[:]:
+            if poll[0]():
+                self.end_long_poll(poll)
+
+    def finish_long_polls(self):
+        """Answer all held requests now, with their current values; the
+        session will not make any more progress.
+        """
+        for poll in self.long_polls[:]:
+            self.end_long_poll(poll)
 
     def get_state_machine_callbacks(self):
         return [(self.handshake, False, -1),
@@ -191,6 +290,7 @@ class CoinSwapCarol(CoinSwapParticipant):
             self.coinswap_parameters.set_pubkey("key_TX2_lock", params[2])
             self.coinswap_parameters.set_pubkey("key_TX3_secret", params[3])
             #Client's locktimes must be in the acceptable range.
+            get_chain_tip().refresh(LOCKTIME_CHECK_TIP_MAX_AGE)
             cbh = get_current_blockheight()
             serverlockrange = cs_single().config.get("SERVER",
                                                      "server_locktime_range")
@@ -214,7 +314,7 @@ class CoinSwapCarol(CoinSwapParticipant):
             return (False,
                     "Invalid parameter set from counterparty, abandoning: " + \
                     repr(e))
-
+        self.reserve_addresses()
         #on receipt of valid response, complete the CoinswapPublicParameters instance
         for k in self.required_key_names:
             self.coinswap_parameters.set_pubkey(k, self.keyset[k][1])
@@ -358,8 +458,7 @@ class CoinSwapCarol(CoinSwapParticipant):
         self.tx3.attach_signatures()
         self.watch_for_tx(self.tx3)
         #wait until TX0 is seen before pushing ours.
-        self.loop = task.LoopingCall(self.check_for_phase1_utxos, [self.txid0])
-        self.loop.start(3.0)        
+        self.check_for_phase1_utxos([self.txid0])
         return (True, "Received TX3 sig OK")
 
     def push_tx1(self):
@@ -372,11 +471,9 @@ class CoinSwapCarol(CoinSwapParticipant):
         cs_single().bc_interface.rpc("importaddress",
                             [self.tx1.output_address, "joinmarket-notify", False])
         #Wait until TX1 seen before confirming phase2 ready.
-        self.loop = task.LoopingCall(self.check_for_phase1_utxos,
-                                         [self.tx1.txid + ":" + str(
-                                             self.tx1.pay_out_index)],
-                                         self.receive_confirmation_tx_0_1)
-        self.loop.start(3.0)
+        self.check_for_phase1_utxos([self.tx1.txid + ":" + str(
+                                        self.tx1.pay_out_index)],
+                                    self.receive_confirmation_tx_0_1)
         return (True, "TX1 broadcast OK")
 
     def receive_confirmation_tx_0_1(self):
@@ -385,6 +482,7 @@ class CoinSwapCarol(CoinSwapParticipant):
         *1* confirmation, could be safer.
         """
         self.phase2_ready = True
+        self.update_long_polls()
 
     def is_phase2_ready(self):
         return self.phase2_ready
@@ -438,20 +536,13 @@ class CoinSwapCarol(CoinSwapParticipant):
         errmsg, success = self.tx4.push()
         if not success:
             return (False, "Failed to push TX4")
-        self.tx4_loop = task.LoopingCall(self.wait_for_tx4_confirmed)
-        self.tx4_loop.start(3.0)
+        self.wait_for_confirmations([self.tx4.txid + ":0"], 1,
+                                    self.receive_tx4_confirmation)
         return (True, "OK")
 
-    def wait_for_tx4_confirmed(self):
-        result = cs_single().bc_interface.query_utxo_set([self.tx4.txid+":0"],
-                                                         includeconf=True)
-        if None in result:
-            return
-        for u in result:
-            if u['confirms'] < 1:
-                return
-        self.tx4_loop.stop()
+    def receive_tx4_confirmation(self):
         self.tx4_confirmed = True
+        self.update_long_polls()
         cslog.info("Carol received: " + self.tx4.txid + ", now ending.")
         self.quit()
 
@@ -491,7 +582,7 @@ class CoinSwapCarol(CoinSwapParticipant):
             cslog.info("Failed to find TX3 txid, cannot redeem from it")
             return False
         #**CONSTRUCT TX3-redeem-timeout; use a fresh address to redeem
-        dest_addr = self.wallet.get_new_addr(0, 1, True)
+        dest_addr = get_address_pool(self.wallet).take(0, 1)
         self.tx3redeem = CoinSwapRedeemTX23Timeout(
             self.coinswap_parameters.pubkeys["key_TX3_secret"],
             self.hashed_secret,
@@ -523,7 +614,7 @@ class CoinSwapCarol(CoinSwapParticipant):
             cslog.info(self.tx2.fully_signed_tx)
             return False
         #**CONSTRUCT TX2-redeem-secret; use a fresh address to redeem
-        dest_addr = self.wallet.get_new_addr(0, 1, True)
+        dest_addr = get_address_pool(self.wallet).take(0, 1)
         tx2redeem_secret = CoinSwapRedeemTX23Secret(self.secret,
                         self.coinswap_parameters.pubkeys["key_TX2_secret"],
                         self.coinswap_parameters.timeouts["LOCK0"],
@@ -555,6 +646,7 @@ class CoinSwapCarol(CoinSwapParticipant):
         assert self.sm.state in [6, 7, 8]
         if self.tx3redeem.is_confirmed:
             self.carol_watcher_loop.stop()
+            get_mempool_watcher().unwatch(self.tx3.txid + ":0")
             cslog.info("Redeemed funds via TX3 OK, txid of redeeming transaction "
                       "is: " + self.tx3redeem.txid)
             self.quit(complete=False, failed=False)
@@ -571,25 +663,172 @@ class CoinSwapCarol(CoinSwapParticipant):
                 self.quit(False, not rt2s_success)
                 return
 
+    def backout(self, backoutmsg, verbose=True):
+        self.finish_long_polls()
+        super(CoinSwapCarol, self).backout(backoutmsg, verbose)
+
+    def quit(self, complete=True, failed=False):
+        self.finish_long_polls()
+        if self.tx3 and self.tx3.txid:
+            get_mempool_watcher().unwatch(self.tx3.txid + ":0")
+        super(CoinSwapCarol, self).quit(complete, failed)
+
+    def watch_mempool_for_tx3_spend(self):
+        """Watch for a spend of TX3 appearing in the mempool, so that
+        a secret revealed by Alice is seen before it confirms and
+        without relying on the wallet's spend notification.
+        """
+        if not self.tx3.txid:
+            self.tx3.set_txid()
+        utxo = self.tx3.txid + ":0"
+        if utxo not in get_mempool_watcher().subscriptions:
+            get_mempool_watcher().watch(utxo, self.tx3_spend_in_mempool)
+
+    def tx3_spend_in_mempool(self, utxo, spending_tx):
+        spending_txid = btc.txhash(spending_tx)
+        tx3redeem = getattr(self, "tx3redeem", None)
+        if tx3redeem and tx3redeem.txid == spending_txid:
+            #our own redeem; keep watching for a conflicting spend
+            return
+        cslog.info("Seen TX3 spent in mempool by: " + spending_txid)
+        get_mempool_watcher().unwatch(utxo)
+        self.tx3.spent_update(btc.deserialize(spending_tx), spending_txid)
+        #no need to wait for LOCK1 any more
+        self.wake_backout_now()
+
+    def get_time_to_lock0(self):
+        """Rough estimate, in seconds, of the time left before LOCK0,
+        after which Alice can reclaim TX2.
+        """
+        return max(self.coinswap_parameters.timeouts["LOCK0"] - \
+                   get_current_blockheight(), 0) * 600.0
+
     def scan_blockchain_for_secret(self):
         """Only required by Carol; in cases where the wallet
         monitoring fails (principally because a secret-redeeming
         transaction by Alice occurred when we were not on-line),
-        we must be able to find the secret directly from scanning
-        the blockchain. This could be achieved with indexing on
+        we must be able to find the secret directly from the blockchain.
+        In order of cost, we try the server's secret index, then the
+        transaction spending TX3 as recorded by our Bitcoin Core wallet
+        (the TX3 address is imported watch-only), and as a last resort
+        scan the relevant blocks (see scan_blocks_for_secret).
+        Returns a Deferred firing with True if the secret was found.
+        """
+        index = cs_single().secret_index
+        if index:
+            retval = index.lookup(self.hashed_secret)
+            if retval:
+                cslog.info("Found secret in the secret index.")
+                self.secret = retval
+                return defer.succeed(True)
+        if not self.tx3.txid:
+            return self.scan_blocks_for_secret()
+        d = threads.deferToThread(find_outpoint_spender, self.tx3.txid + ":0")
+        d.addCallbacks(self.receive_tx3_spender, self.tx3_spender_failed)
+        return d
+
+    def receive_tx3_spender(self, spending_tx):
+        if spending_tx:
+            cslog.info("Found the TX3 spend in our Bitcoin Core wallet.")
+            self.tx3.spent_update(btc.deserialize(spending_tx),
+                                  btc.txhash(spending_tx))
+            if self.find_secret_from_tx3_redeem():
+                return True
+        return self.scan_blocks_for_secret()
+
+    def tx3_spender_failed(self, failure):
+        cslog.info("Failed to look up TX3 spend in wallet: " + str(
+            failure.value))
+        return self.scan_blocks_for_secret()
+
+    def scan_blocks_for_secret(self):
+        """Scans the blocks in which Alice could have redeemed TX3
+        for the secret. This could be achieved with indexing on
         our Bitcoin Core instance, but since this requires a lot of
         resources, it's simpler to directly parse the relevant blocks.
+        The scan is shared with any other sessions scanning at the same
+        time; returns a Deferred firing with True if the secret was found.
+        Blocks already scanned by this session (recorded in its state) or
+        by the secret index are not scanned again.
         """
         bh = get_current_blockheight()
         starting_blockheight = self.coinswap_parameters.timeouts[
             "LOCK0"] - cs_single().config.getint("TIMEOUT", "lock_client")
-        while bh >= starting_blockheight:
-            found_txs = get_transactions_from_block(bh)
-            for t in found_txs:
-                retval = get_secret_from_vin(t['ins'], self.hashed_secret)
-                if retval:
-                    self.secret = retval
-                    return True
-            bh -= 1
-        cslog.info("Failed to find secret from scanning blockchain.")
-        return False
+        index = cs_single().secret_index
+        if index:
+            #only blocks not yet indexed need to be scanned
+            if index.covers(starting_blockheight):
+                starting_blockheight = index.tip_height + 1
+            elif index.covers(bh):
+                bh = index.start_height - 1
+        ranges = self.get_unscanned_ranges(starting_blockheight, bh)
+        if not ranges:
+            cslog.info("Secret not found in blocks already searched.")
+            return defer.succeed(False)
+        d = get_secret_scan_coordinator().request(self.hashed_secret, ranges,
+            lambda heights: self.record_scan_progress(heights, ranges))
+        d.addCallback(self.receive_scanned_secret)
+        return d
+
+    def get_unscanned_ranges(self, start_height, end_height):
+        """Returns the (lowest, highest) height ranges between start_height
+        and end_height not yet scanned for the secret.
+        """
+        if start_height > end_height:
+            return []
+        if not self.secret_scan_covered:
+            return [(start_height, end_height)]
+        lo, hi = self.secret_scan_covered
+        ranges = [(max(start_height, hi + 1), end_height),
+                  (start_height, min(end_height, lo - 1))]
+        return [r for r in ranges if r[0] <= r[1]]
+
+    def record_scan_progress(self, heights, ranges):
+        """Extend the contiguous range of heights scanned for the secret
+        with those in heights, persisting it if changed. The scan may be
+        shared with other sessions, so only heights in this session's
+        ranges (as from get_unscanned_ranges) count; a new range starts
+        from the end of them scanned first (the highest).
+        """
+        heights = set([h for h in heights if any(
+            [lo <= h <= hi for lo, hi in ranges])])
+        covered = self.secret_scan_covered
+        if covered:
+            lo, hi = covered
+        else:
+            end_height = max([r[1] for r in ranges])
+            if end_height not in heights:
+                return
+            lo, hi = end_height, end_height
+        while hi + 1 in heights:
+            hi += 1
+        while lo - 1 in heights:
+            lo -= 1
+        if [lo, hi] != covered:
+            self.secret_scan_covered = [lo, hi]
+            self.persist()
+
+    def receive_scanned_secret(self, secret):
+        if not secret:
+            cslog.info("Failed to find secret from scanning blockchain.")
+            return False
+        self.secret = secret
+        return True
+
+    def redeem_tx2_after_scan(self, scan_success, tx3_errmsg):
+        """Called with the result of scanning for the secret, after
+        failing to broadcast TX3 in backout.
+        """
+        if scan_success:
+            rt2s_success = self.redeem_tx2_with_secret()
+            self.quit(False, not rt2s_success)
+            return
+        #TODO: corner case: TX3 broadcast, but for some reason
+        #not recorded as broadcast (restart), but not redeemed.
+        cslog.info("Failed to broadcast TX3, "
+                  "RPC error message: " + tx3_errmsg)
+        cslog.info("Failed to broadcast TX3; here is raw form: ")
+        cslog.info(self.tx3.fully_signed_tx)
+        cslog.info("Readable form: ")
+        cslog.info(self.tx3)
+        self.quit(False, True)
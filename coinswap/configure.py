@@ -76,12 +76,39 @@ class AttributeDict(object):
 
 
 global_singleton = AttributeDict()
-global_singleton.CSCS_VERSION = 0.1
+#0.2: phase2_ready and confirm_tx4 take a long-poll timeout argument
+global_singleton.CSCS_VERSION = 0.2
 global_singleton.APPNAME = "CoinSwapCS"
 global_singleton.homedir = None
 global_singleton.BITCOIN_DUST_THRESHOLD = 2730
 global_singleton.DUST_THRESHOLD = 10 * global_singleton.BITCOIN_DUST_THRESHOLD
 global_singleton.bc_interface = None
+#Only used by the server; see scanner.SecretIndex
+global_singleton.secret_index = None
+#Only used by the server; see scanner.SecretScanCoordinator
+global_singleton.secret_scan_coordinator = None
+#See blockcache.BlockCache
+global_singleton.block_cache = None
+#See mempool.MempoolWatcher
+global_singleton.mempool_watcher = None
+#See notify.ConfirmationNotifier
+global_singleton.confirmation_notifier = None
+#See notify.HeightScheduler
+global_singleton.height_scheduler = None
+#See notify.ChainTip
+global_singleton.chain_tip = None
+#The listening port of notify.ChainNotifyResource, once started
+global_singleton.chain_notify_port = None
+#Only used by the server; see keypool.KeypairPool
+global_singleton.keypair_pool = None
+#Only used by the server; see addresspool.AddressPool
+global_singleton.address_pool = None
+#role : state_machine.StateLatencies
+global_singleton.state_latencies = {}
+#key : rtt.RTTEstimator, loaded on first use
+global_singleton.rtt_estimators = None
+#see rtt.RTTSampleFile
+global_singleton.rtt_sample_file = None
 global_singleton.logs_path = None
 global_singleton.config = SafeConfigParser()
 #This is reset to a full path after load_coinswap_config call
@@ -106,18 +133,46 @@ rpc_host = localhost
 rpc_port = 8332
 rpc_user = bitcoin
 rpc_password = password
+#If non-zero, confirmations are detected when bitcoind notifies us of new
+#blocks and wallet transactions via HTTP on this local port, instead of by
+#polling every 3 seconds. Add to bitcoin.conf (using the same port):
+#blocknotify=curl -s http://127.0.0.1:62650/blocknotify?%s
+#walletnotify=curl -s http://127.0.0.1:62650/walletnotify?%s
+chain_notify_port = 0
 
 [TIMEOUT]
 #How long to wait, by default, in seconds, before giving up on the counterparty
 #and executing backout. This is only applied in cases where response is intended
 #to be immediate.
 default_network_timeout = 60
+#Timeouts of the states waiting for an immediate response from the
+#counterparty are learned from the response times seen, per server (as client)
+#or per transport (as server): network_timeout_factor times the
+#network_timeout_percentile'th percentile of recent response times, bounded by
+#network_timeout_floor and network_timeout_ceiling (seconds).
+#default_network_timeout is used until enough responses are seen.
+network_timeout_percentile = 95
+network_timeout_factor = 3
+network_timeout_floor = 20
+network_timeout_ceiling = 180
 #How long to wait (in seconds, integer only) for the counterparty to confirm
 #blockchain state that we've already seen (if client);
 #this is to account for propagation delays on the BTC network,
 #mainly. Used in waiting to proceed to second phase after first (TX0,TX1) is
 #complete.
 propagation_buffer = 120
+#Maximum time (seconds) a polling request such as phase2_ready is held open
+#by the server, waiting for the answer to change, before it replies; this
+#replaces repeated polling by the client.
+long_poll_timeout = 60
+#Where bitcoind has to be polled (e.g. when chain_notify_port is not set),
+#polls start this many seconds apart, back off by the factor poll_backoff
+#while nothing changes, up to poll_interval_max seconds, and are brought back
+#to the minimum when a new block is seen. Raise these to reduce the load on
+#bitcoind from a server running many coinswaps.
+poll_interval_min = 3
+poll_interval_max = 30
+poll_backoff = 1.5
 #How many blocks to wait for ensured confirmation for the first stage (funding) txs.
 #Note that the this value must be agreed with the server.
 tx01_confirm_wait = 2
@@ -232,6 +287,20 @@ client_locktime_range = 20,100
 tx01_confirm_range = 2, 4
 #to reduce load/complexity, an upper limit on the number of concurrent coinswaps
 maximum_concurrent_coinswaps = 3
+#requests larger than this many bytes are rejected without being parsed;
+#no valid coinswap message comes close to it.
+max_request_bytes = 100000
+#The status served to clients is cached, and rebuilt when a coinswap starts or
+#finishes or a new block arrives; as a backstop for other changes (e.g. to the
+#wallet balance) it is also rebuilt once older than this many seconds.
+status_max_age = 30
+#Fresh destination addresses for coinswaps are derived in advance; this many
+#are kept ready for each wallet branch used. It must be below the wallet's gap
+#limit (6), or it is reduced to fit.
+address_pool_size = 4
+#Ephemeral keypairs for coinswaps are computed in advance, in a background
+#thread; this many are kept ready.
+keypair_pool_size = 20
 #**FEES**
 #Note that fees are by default collected across two different outputs in combination
 #with other (probably much larger) amounts, so a small fee doesn't imply a dust
@@ -248,6 +317,21 @@ coinswap_fee_percent = 0.5
 #below the minimum).
 blinding_amount_min = 2000000
 blinding_amount_max = 50000000
+#**SECRET SCANNING**
+#In some backout cases the server must find the coinswap secret by scanning
+#recent blocks. Blocks are fetched from Bitcoin Core with at most this many
+#concurrent RPC calls:
+secret_scan_rpc_concurrency = 4
+#If true, the server keeps an index of candidate secrets revealed in all new
+#blocks (in the file secretindex.json in the data directory), so that in most
+#cases no scanning is needed at all.
+use_secret_index = true
+#Blocks fetched from Bitcoin Core are kept in memory, up to this many MB,
+#so that repeated scans of the same blocks do not fetch them again.
+block_cache_mb = 64
+#If non-zero, fetched blocks are also stored (up to this many MB) in the
+#blockcache directory in the data directory, which survives restarts.
+block_cache_disk_mb = 0
 """
 
 def lookup_appdata_folder():
@@ -1,9 +1,11 @@
 import os
 import binascii
 import json
+import time
 
 from txjsonrpc.web.jsonrpc import Proxy
 from txjsonrpc.web import jsonrpc
+from txjsonrpc import jsonrpclib
 from twisted.web import server
 from twisted.internet import reactor
 try:
@@ -16,6 +18,9 @@ from .base import (get_current_blockheight, CoinSwapPublicParameters,
 from .alice import CoinSwapAlice
 from .carol import CoinSwapCarol
 from .configure import get_log, cs_single, get_network
+from .rtt import get_rtt_estimator
+from .notify import get_chain_tip
+from .addresspool import get_address_pool
 from twisted.internet import defer  
 
 cslog = get_log()
@@ -91,6 +96,31 @@ class CoinSwapJSONRPCClient(object):
         d = self.proxy.callRemote(method, *args)
         d.addCallback(self.json_callback).addErrback(self.error)
 
+class SizeLimitedRequest(server.Request):
+    """A Request which stops storing its body once it exceeds
+    max_request_bytes (SERVER section of the config), so that an oversized
+    request, whether or not it declares its Content-Length, is never held
+    in memory or on disk; it is flagged too_large, for render() to reject.
+    Used as the requestFactory of the server's Site.
+    """
+    def gotLength(self, length):
+        self.max_request_bytes = cs_single().config.getint(
+            "SERVER", "max_request_bytes")
+        self.too_large = length is not None and length > self.max_request_bytes
+        #never a temporary file; the body is at most max_request_bytes
+        server.Request.gotLength(self, 0)
+
+    def handleContentChunk(self, data):
+        if self.too_large:
+            return
+        if self.content.tell() + len(data) > self.max_request_bytes:
+            self.too_large = True
+            #drop what was received
+            self.content.seek(0, 0)
+            self.content.truncate()
+            return
+        server.Request.handleContentChunk(self, data)
+
 class CoinSwapCarolJSONServer(jsonrpc.JSONRPC):
     def __init__(self, wallet, testing_mode=False, carol_class=CoinSwapCarol,
                  fail_carol_state=None):
@@ -99,23 +129,100 @@ class CoinSwapCarolJSONServer(jsonrpc.JSONRPC):
         self.carol_class = carol_class
         self.fail_carol_state = fail_carol_state
         self.carols = {}
+        #the only methods served; see render()
+        self.methods = {"coinswap": self.jsonrpc_coinswap,
+                        "handshake": self.jsonrpc_handshake,
+                        "status": self.jsonrpc_status}
+        self.max_request_bytes = cs_single().config.getint("SERVER",
+                                                           "max_request_bytes")
+        #used by the base class's response rendering; JSONP is not supported.
+        self.is_jsonp = False
+        self.callback = None
         self.fee_policy = FeePolicy(cs_single().config)
-        self.update_status()
+        #Response times, and so network timeouts, are learned per transport
+        #(the same precedence as in coinswap_run.py), since clients are
+        #not identifiable across sessions.
+        c = cs_single().config
+        if c.get("SERVER", "use_onion") != "false":
+            self.transport = "onion"
+        elif c.get("SERVER", "use_ssl") != "false":
+            self.transport = "ssl"
+        else:
+            self.transport = "tcp"
+        #The status document is cached (see get_status); status_data is
+        #as built by update_status, status adds its version.
+        self.status_data = None
+        self.status = None
+        self.status_version = 0
+        self.status_expiry = 0
+        self.status_max_age = c.getfloat("SERVER", "status_max_age")
+        get_chain_tip().listeners.append(self)
+        self.get_status()
+        #Destination addresses for sessions are taken from a pool (see
+        #CoinSwapCarol.reserve_addresses); start filling it now.
+        for mixdepth, branch in CoinSwapCarol.destination_branches.values():
+            get_address_pool(wallet).fill(mixdepth, branch)
         jsonrpc.JSONRPC.__init__(self)
 
     def render(self, request):
-        """In order to respond appropriately to ill formed requests (no content,
-        or ill-formed content), we return a null response early in this class,
-        overriding render() from the base class, which unfortunately does not
-        correctly handle e.g. browser GET requests.
+        """Replaces render() from the base class, which does not correctly
+        handle ill formed requests (e.g. browser GET requests), and would
+        parse the request a second time: the request is parsed once, its
+        envelope checked, and it is dispatched directly to one of the
+        methods in self.methods. Oversized requests (see max_request_bytes
+        and SizeLimitedRequest) are rejected without being parsed, and ill
+        formed ones with a null response.
         """
+        if getattr(request, "too_large", False):
+            request.setResponseCode(413)
+            return "Request too large."
         request.content.seek(0, 0)
-        content = request.content.read()
+        content = request.content.read(self.max_request_bytes + 1)
+        if len(content) > self.max_request_bytes:
+            request.setResponseCode(413)
+            return "Request too large."
         try:
-            json.loads(content)
+            parsed = json.loads(content)
+            method = parsed["method"]
+            params = parsed.get("params")
+            if params is None:
+                params = []
+            if not isinstance(method, basestring) or not isinstance(params,
+                                                                     list):
+                raise ValueError("Ill formed method or params")
+            request_id = parsed.get("id")
+            version = parsed.get("jsonrpc")
+            if version:
+                version = int(float(version))
+            elif request_id:
+                version = jsonrpclib.VERSION_1
+            else:
+                version = jsonrpclib.VERSION_PRE1
         except:
             return "Nothing here."
-        return jsonrpc.JSONRPC.render(self, request)
+        if method not in self.methods:
+            self._cbRender(jsonrpclib.Fault(self.NOT_FOUND,
+                                            "Method not found: " + repr(method)),
+                           request, request_id, version)
+            return server.NOT_DONE_YET
+        request.setHeader("content-type", "application/json")
+        d = defer.maybeDeferred(self.methods[method], *params)
+        #a held (long poll) response is cancelled if the client goes away
+        request.notifyFinish().addErrback(self.request_lost, request, d)
+        d.addErrback(self._ebRender, request_id)
+        d.addCallback(self.respond, request, request_id, version)
+        return server.NOT_DONE_YET
+
+    def request_lost(self, failure, request, d):
+        request.lost = True
+        d.cancel()
+
+    def respond(self, result, request, request_id, version):
+        """Render result, unless the client has disconnected.
+        """
+        if getattr(request, "lost", False):
+            return
+        self._cbRender(result, request, request_id, version)
 
     def refresh_carols(self):
         """Remove CoinSwapCarol instances that are flagged complete from
@@ -175,12 +282,43 @@ class CoinSwapCarolJSONServer(jsonrpc.JSONRPC):
         status["testnet"] = True if get_network() else False
         return status
 
-    def jsonrpc_status(self):
-        """This can be polled at any time.
-        The call to get_balance_by_mixdepth does not involve sync,
-        so is not resource intensive.
+    def get_status(self):
+        """Returns the cached status document, rebuilding it (with
+        update_status) only if it has been invalidated or is older than
+        status_max_age seconds. Its version is only incremented if the
+        rebuilt document differs.
+        """
+        if time.time() >= self.status_expiry:
+            status = self.update_status()
+            if status != self.status_data:
+                self.status_data = status
+                self.status_version += 1
+                self.status = dict(status, version=self.status_version)
+            self.status_expiry = time.time() + self.status_max_age
+        return self.status
+
+    def invalidate_status(self):
+        """Called when a session starts or finishes, and on a new block
+        (the wallet balance may have changed); call it also if the config
+        is changed.
+        """
+        self.status_expiry = 0
+
+    def notify(self):
+        """The chain tip has changed (see notify.ChainTip).
+        """
+        self.invalidate_status()
+
+    def jsonrpc_status(self, version=None):
+        """This can be polled at any time, and is served from the cache.
+        If the version of the status the caller already has is passed,
+        and it is unchanged, only {"version": version, "unchanged": True}
+        is returned.
         """
-        return self.update_status()
+        status = self.get_status()
+        if version is not None and version == status["version"]:
+            return {"version": version, "unchanged": True}
+        return status
 
     def set_carol(self, carol, sessionid):
         """Once a CoinSwapCarol object has been initiated, its session id
@@ -189,6 +327,8 @@ class CoinSwapCarolJSONServer(jsonrpc.JSONRPC):
         #should be computationally infeasible; note *we* set this.
         assert sessionid not in self.carols
         self.carols[sessionid] = carol
+        carol.completion_callback = self.invalidate_status
+        self.invalidate_status()
         return True
 
     def consume_nonce(self, nonce, sessionid):
@@ -236,27 +376,17 @@ class CoinSwapCarolJSONServer(jsonrpc.JSONRPC):
         is not yet established.
         """
         #Don't accept handshake if we are busy
-        status = self.update_status()
+        status = self.get_status()
         if status["busy"]:
             return (False, "Server is busy, cannot complete handshake")
         #Prepare a new CoinSwapCarol instance for this session
         #start with a unique ID of 16 byte entropy:
         sessionid = binascii.hexlify(os.urandom(16))
-        #Logic for mixdepths:
-        #TX4 output is the normal coinswap output, not combined with original.
-        #TX5 output address functions like change, goes back to original.
-        #TX2/3 are unambiguous coinswap outs, since adversary can deduce
-        #who they belong to, no point in isolating them (go back to start).
-        tx4address = self.wallet.get_new_addr(1, 1, True)
-        tx2_carol_address = self.wallet.get_new_addr(0, 1, True)
-        tx3_carol_address = self.wallet.get_new_addr(0, 1, True)
-        tx5_carol_address = self.wallet.get_new_addr(0, 1, True)
+        #Carol's destination addresses are only reserved once parameter
+        #negotiation succeeds; see CoinSwapCarol.reserve_addresses.
         cpp = CoinSwapPublicParameters()
         cpp.set_session_id(sessionid)
         cpp.set_fee_policy(self.fee_policy)
-        cpp.set_addr_data(addr4=tx4address, addr_2_carol= tx2_carol_address,
-                          addr_3_carol=tx3_carol_address,
-                          addr_5_carol=tx5_carol_address)
         try:
             if self.fail_carol_state:
                 if not self.set_carol(self.carol_class(self.wallet, 'carolstate',
@@ -272,4 +402,6 @@ class CoinSwapCarolJSONServer(jsonrpc.JSONRPC):
             return (False, "Error in setting up handshake: " + repr(e))
         if not self.consume_nonce(alice_handshake[1]["nonce"], sessionid):
             return (False, "Invalid nonce in handshake.")
+        self.carols[sessionid].sm.set_rtt_estimator(get_rtt_estimator(
+            self.transport))
         return self.carols[sessionid].sm.tick(alice_handshake)
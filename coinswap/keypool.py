@@ -0,0 +1,76 @@
+from __future__ import print_function
+"""Ephemeral keypairs for coinswap sessions, precomputed in a worker
+thread so that creating a session (in the server, while handling the
+handshake) does no EC point multiplication.
+"""
+
+import binascii
+import os
+import threading
+import Queue
+import jmbitcoin as btc
+from twisted.internet import reactor
+from .configure import get_log, cs_single
+
+cslog = get_log()
+
+def generate_privkey():
+    #always hex, with compressed flag
+    return binascii.hexlify(os.urandom(32)) + "01"
+
+def generate_keypair():
+    privkey = generate_privkey()
+    return (privkey, btc.privkey_to_pubkey(privkey))
+
+class KeypairPool(object):
+    """Keeps up to size (privkey, pubkey) pairs ready, computed by a
+    worker thread once start() is called. Each pair is handed out by
+    take() exactly once, and only held in memory; if none is ready, one
+    is computed by the caller.
+    """
+    def __init__(self, size):
+        self.keypairs = Queue.Queue(maxsize=size)
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Start the worker thread; it is stopped on reactor shutdown.
+        """
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.fill, name="KeypairPool")
+        self.thread.daemon = True
+        self.thread.start()
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def fill(self):
+        keypair = None
+        while not self.stopping.is_set():
+            if not keypair:
+                keypair = generate_keypair()
+            try:
+                #waits while the pool is full
+                self.keypairs.put(keypair, timeout=1)
+                keypair = None
+            except Queue.Full:
+                pass
+
+    def take(self):
+        try:
+            return self.keypairs.get_nowait()
+        except Queue.Empty:
+            cslog.info("Keypair pool empty, generating keypair.")
+            return generate_keypair()
+
+def get_keypair_pool():
+    """The process-wide KeypairPool, with the size set in the SERVER
+    section of the config; it is only started by the server.
+    """
+    if not cs_single().keypair_pool:
+        cs_single().keypair_pool = KeypairPool(
+            cs_single().config.getint("SERVER", "keypair_pool_size"))
+    return cs_single().keypair_pool
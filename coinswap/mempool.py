@@ -0,0 +1,143 @@
+from __future__ import print_function
+"""Watching the mempool of our Bitcoin Core node for spends of specific
+outpoints, so that a counterparty's spend (and any secret it reveals)
+can be acted on before it confirms.
+"""
+
+import binascii
+import struct
+import jmbitcoin as btc
+from twisted.internet import threads
+from .configure import get_log, cs_single
+from .scanner import get_thread_rpc
+from .notify import AdaptiveLoop
+
+cslog = get_log()
+
+def serialize_outpoint(utxo):
+    """The hex form of the outpoint utxo (txid:n) as it appears in
+    a serialized transaction input.
+    """
+    txid, n = utxo.split(":")
+    return binascii.hexlify(binascii.unhexlify(txid)[::-1] + struct.pack(
+        "<I", int(n)))
+
+class MempoolWatcher(object):
+    """Polls the mempool for transactions spending any of a set of
+    watched outpoints. Each poll fetches the list of mempool txids and
+    then only the transactions which arrived since the previous poll;
+    those not containing a watched outpoint in their raw bytes are never
+    deserialized. An outpoint watched after the first poll is also
+    checked on the next one for a spend already in the mempool (which
+    would not be among the new transactions). Fetching is done in a
+    thread; subscriber callbacks are called on the reactor thread with
+    (utxo, serialized spending tx).
+    The loop only runs while there are outpoints watched, at intervals
+    set by a PollingPolicy.
+    """
+    def __init__(self):
+        #utxo : [callbacks]
+        self.subscriptions = {}
+        #txids in the mempool at the last poll
+        self.known = None
+        #utxos watched since the last poll started, and those being
+        #checked in the current poll
+        self.new_utxos = set()
+        self.polling_new_utxos = set()
+        self.polling = False
+        self.loop = AdaptiveLoop(self.poll, follow_tip=True)
+
+    def watch(self, utxo, callback):
+        if utxo not in self.subscriptions:
+            self.new_utxos.add(utxo)
+        self.subscriptions.setdefault(utxo, []).append(callback)
+        if not self.loop.running:
+            self.loop.start()
+
+    def unwatch(self, utxo):
+        self.subscriptions.pop(utxo, None)
+        self.new_utxos.discard(utxo)
+        if not self.subscriptions and self.loop.running:
+            self.loop.stop()
+            self.known = None
+
+    def poll(self):
+        if self.polling or not self.subscriptions:
+            return
+        self.polling = True
+        self.polling_new_utxos = self.new_utxos
+        self.new_utxos = set()
+        d = threads.deferToThread(self.fetch_spends,
+                                  set(self.subscriptions.keys()), self.known,
+                                  self.polling_new_utxos)
+        d.addCallback(self.receive_spends)
+        d.addErrback(self.poll_failed)
+
+    def is_spent_in_mempool(self, rpc, utxo, mempool):
+        txid, n = utxo.split(":")
+        if txid in mempool:
+            #any spend must also be in the mempool
+            return True
+        return rpc.call("gettxout", [txid, int(n), True]) is None and \
+               rpc.call("gettxout", [txid, int(n), False]) is not None
+
+    def fetch_spends(self, utxos, known, new_utxos):
+        """Runs in a thread; returns the current mempool txids and a
+        list of (utxo, serialized tx) for each spend of one of utxos
+        by a transaction not in known, and of one of new_utxos by any
+        transaction.
+        """
+        rpc = get_thread_rpc()
+        mempool = set(rpc.call("getrawmempool", []))
+        if known is None:
+            #first poll: every outpoint is new
+            known = mempool
+            new_utxos = utxos
+        spends = self.find_spends(rpc, mempool - known, utxos)
+        #Only look through the rest of the mempool for new outpoints
+        #which are already spent in it.
+        spent = set([u for u in new_utxos & utxos
+                     if self.is_spent_in_mempool(rpc, u, mempool)])
+        if spent:
+            spends += self.find_spends(rpc, mempool & known, spent)
+        return (mempool, spends)
+
+    def find_spends(self, rpc, txids, utxos):
+        """Returns (utxo, serialized tx) for each spend of one of utxos
+        by one of the mempool transactions txids.
+        """
+        outpoints = dict([(serialize_outpoint(u), u) for u in utxos])
+        spends = []
+        for txid in txids:
+            try:
+                rawtx = rpc.call("getrawtransaction", [txid])
+            except Exception:
+                #left the mempool since it was listed
+                continue
+            if not any([o in rawtx for o in outpoints]):
+                continue
+            for inp in btc.deserialize(rawtx)["ins"]:
+                u = inp["outpoint"]["hash"] + ":" + str(
+                    inp["outpoint"]["index"])
+                if u in utxos:
+                    spends.append((u, rawtx))
+        return spends
+
+    def receive_spends(self, result):
+        self.polling = False
+        self.known, spends = result
+        for utxo, rawtx in spends:
+            for callback in self.subscriptions.get(utxo, []):
+                callback(utxo, rawtx)
+
+    def poll_failed(self, failure):
+        self.polling = False
+        #check these again on the next poll
+        self.new_utxos |= set([u for u in self.polling_new_utxos
+                               if u in self.subscriptions])
+        cslog.info("Failed to poll mempool: " + str(failure.value))
+
+def get_mempool_watcher():
+    if not cs_single().mempool_watcher:
+        cs_single().mempool_watcher = MempoolWatcher()
+    return cs_single().mempool_watcher
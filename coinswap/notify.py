@@ -0,0 +1,352 @@
+from __future__ import print_function
+"""Notification of blockchain events (new blocks, wallet transactions)
+from bitcoind, and the services that act on them instead of each session
+polling bitcoind on its own.
+"""
+
+import abc
+import copy
+import time
+from twisted.internet import reactor, threads
+from twisted.web import resource
+from .configure import get_log, cs_single
+
+cslog = get_log()
+
+class ChainNotifyResource(resource.Resource):
+    """A local HTTP hook for bitcoind's notifications; bitcoin.conf
+    should contain (with the configured chain_notify_port):
+    blocknotify=curl -s http://127.0.0.1:port/blocknotify?%s
+    walletnotify=curl -s http://127.0.0.1:port/walletnotify?%s
+    A block notification triggers all the listeners in block_listeners,
+    a wallet notification those in tx_listeners; the block hash or txid
+    is not needed. Tests can call listener.notify() directly.
+    """
+    isLeaf = True
+
+    def __init__(self, block_listeners, tx_listeners):
+        resource.Resource.__init__(self)
+        self.listeners = {"/blocknotify": block_listeners,
+                          "/walletnotify": tx_listeners}
+
+    def render_GET(self, request):
+        if request.path not in self.listeners:
+            request.setResponseCode(404)
+            return "Unknown notification"
+        for listener in self.listeners[request.path]:
+            listener.notify()
+        return "OK"
+
+def query_confirmations(utxos):
+    """Returns a dict of utxo : confirmations (None if not in the
+    confirmed UTXO set) for the list utxos, as one batch JSON-RPC request
+    however many there are.
+    """
+    if not utxos:
+        return {}
+    requests = []
+    for i, utxo in enumerate(utxos):
+        txid, n = utxo.split(":")
+        requests.append({"method": "gettxout", "params": [txid, int(n), False],
+                         "id": i})
+    result = {}
+    for r in cs_single().bc_interface.jsonRpc.queryHTTP(requests):
+        if r.get("error") or not r.get("result"):
+            result[utxos[r["id"]]] = None
+        else:
+            result[utxos[r["id"]]] = int(r["result"]["confirmations"])
+    return result
+
+class PollingPolicy(object):
+    """Decides the interval between polls: it starts at min_interval and
+    grows by a factor of backoff after each poll, up to max_interval, since
+    while idle nothing is likely to change until the next block; reset()
+    (e.g. on a new chain tip) returns it to min_interval. It is also kept
+    below a tenth of the time left to any deadline.
+    Defaults are read from the TIMEOUT section of the config.
+    """
+    def __init__(self, min_interval=None, max_interval=None, backoff=None):
+        c = cs_single().config
+        if min_interval is None:
+            min_interval = c.getfloat("TIMEOUT", "poll_interval_min")
+        if max_interval is None:
+            max_interval = c.getfloat("TIMEOUT", "poll_interval_max")
+        if backoff is None:
+            backoff = c.getfloat("TIMEOUT", "poll_backoff")
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def reset(self):
+        self.interval = self.min_interval
+
+    def next_interval(self, time_left=None):
+        """Returns the interval before the next poll, given the time (in
+        seconds) left to a deadline, if any, and backs off.
+        """
+        interval = self.interval
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        if time_left is not None:
+            interval = min(interval, max(self.min_interval, time_left / 10.0))
+        return interval
+
+def get_fallback_policy():
+    """The PollingPolicy for polls that back up chain notifications;
+    if notifications are configured they need only be infrequent.
+    """
+    if cs_single().config.getint("BLOCKCHAIN", "chain_notify_port"):
+        max_interval = cs_single().config.getfloat("TIMEOUT",
+                                                   "poll_interval_max")
+        return PollingPolicy(max_interval, max_interval, 1.0)
+    return PollingPolicy()
+
+class AdaptiveLoop(object):
+    """Like task.LoopingCall, but the interval between calls of
+    f(*args) is set by a PollingPolicy. time_left, if given, is called
+    before each wait and returns the seconds left to a deadline (or None).
+    If follow_tip is set, the interval is reset whenever the chain tip
+    changes (see ChainTip), when a change is most likely.
+    """
+    def __init__(self, f, args=(), policy=None, time_left=None,
+                 follow_tip=False):
+        self.f = f
+        self.args = args
+        self.policy = policy if policy else PollingPolicy()
+        self.time_left = time_left
+        self.follow_tip = follow_tip
+        self.running = False
+        self.call = None
+
+    def start(self, now=True):
+        self.running = True
+        self.policy.reset()
+        if self.follow_tip:
+            get_chain_tip().listeners.append(self)
+        if now:
+            self.run()
+        else:
+            self.schedule()
+
+    def stop(self):
+        self.running = False
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.follow_tip and self in get_chain_tip().listeners:
+            get_chain_tip().listeners.remove(self)
+
+    def notify(self):
+        """Poll again soon, at the minimum interval."""
+        self.reset()
+
+    def reset(self):
+        if not self.running:
+            return
+        self.policy.reset()
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.schedule()
+
+    def schedule(self):
+        time_left = self.time_left() if self.time_left else None
+        self.call = reactor.callLater(self.policy.next_interval(time_left),
+                                      self.run)
+
+    def run(self):
+        self.call = None
+        try:
+            self.f(*self.args)
+        except Exception as e:
+            cslog.info("Polling call failed: " + repr(e))
+        if self.running and not self.call:
+            self.schedule()
+
+class NotifiedService(object):
+    """Base for services which keep a set of waiting callbacks and check
+    them when notified of a chain event (see ChainNotifyResource, ChainTip),
+    and otherwise only on a fallback poll (in case a notification is
+    lost), whose interval is set by get_fallback_policy(). Subclasses
+    implement check_waiters(); the poll only runs while there are waiters.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, policy=None):
+        #waiter id : subclass specific tuple, ending with the callback
+        self.waiters = {}
+        self.next_id = 0
+        self.check_scheduled = False
+        self.loop = AdaptiveLoop(self.check, policy=policy if policy else \
+                                 get_fallback_policy())
+
+    def add_waiter(self, waiter):
+        self.next_id += 1
+        self.waiters[self.next_id] = waiter
+        if not self.loop.running:
+            self.loop.start(now=False)
+        self.notify()
+        return self.next_id
+
+    def cancel(self, waiter_id):
+        self.waiters.pop(waiter_id, None)
+
+    def notify(self):
+        """Schedule a check; any number of notifications arriving
+        together result in one check.
+        """
+        if not self.check_scheduled:
+            self.check_scheduled = True
+            reactor.callLater(0, self.check)
+
+    def check(self):
+        self.check_scheduled = False
+        if self.waiters:
+            try:
+                self.check_waiters()
+            except Exception as e:
+                #keep the loop running; the next check will retry.
+                cslog.info(self.__class__.__name__ + " check failed: " + repr(
+                    e))
+        if not self.waiters and self.loop.running:
+            self.loop.stop()
+
+    @abc.abstractmethod
+    def check_waiters(self):
+        pass
+
+class ConfirmationNotifier(NotifiedService):
+    """Calls back once when each registered set of outpoints has all
+    reached a number of confirmations. It serves every session in the
+    process: each check queries all the outpoints registered, by all
+    sessions, in a single batch RPC request.
+    """
+    def register(self, utxos, confirms, callback):
+        """callback() is called once all of utxos (list of txid:n) have
+        at least confirms confirmations. Returns an id for cancel().
+        """
+        return self.add_waiter((utxos, confirms, callback))
+
+    def check_waiters(self):
+        utxos = set()
+        for w in self.waiters.values():
+            utxos.update(w[0])
+        confirmations = query_confirmations(list(utxos))
+        for waiter_id, (utxos, confirms, callback) in self.waiters.items():
+            if waiter_id not in self.waiters:
+                #cancelled by an earlier callback in this check
+                continue
+            if any([confirmations[u] is None or confirmations[u] < confirms
+                    for u in utxos]):
+                continue
+            del self.waiters[waiter_id]
+            callback()
+
+class ChainTip(object):
+    """The current chain tip: height, block hash and median time past.
+    It is kept up to date by bitcoind's block notifications, or else a
+    single poll for the whole process, so that reading it (see
+    get_current_blockheight) needs no RPC call on the reactor thread.
+    Services in listeners are notified whenever the tip changes.
+    """
+    def __init__(self, policy=None):
+        self.height = None
+        self.blockhash = None
+        self.mediantime = None
+        #time of the last successful read of the tip
+        self.updated = None
+        self.listeners = []
+        #used from one pool thread at a time
+        self.rpc = copy.copy(cs_single().bc_interface.jsonRpc)
+        self.updating = False
+        self.loop = AdaptiveLoop(self.notify, policy=policy if policy else \
+                                 get_fallback_policy())
+
+    def start(self):
+        """Reads the tip synchronously (once), then follows it.
+        """
+        self.set_tip(self.fetch_tip())
+        self.loop.start(now=False)
+
+    def fetch_tip(self):
+        return self.rpc.call("getblockchaininfo", [])
+
+    def refresh(self, max_age):
+        """Reads the tip synchronously if it was last read more than
+        max_age seconds ago, for checks that must not act on a stale
+        height. Uses the reactor thread's RPC connection, since self.rpc
+        may be in use in a pool thread.
+        """
+        if self.updated is not None and time.time() - self.updated <= max_age:
+            return
+        self.set_tip(cs_single().bc_interface.jsonRpc.call(
+            "getblockchaininfo", []))
+
+    def notify(self):
+        if self.updating:
+            return
+        self.updating = True
+        d = threads.deferToThread(self.fetch_tip)
+        d.addCallback(self.set_tip)
+        d.addErrback(self.update_failed)
+
+    def set_tip(self, info):
+        self.updating = False
+        changed = info["bestblockhash"] != self.blockhash
+        self.height = info["blocks"]
+        self.blockhash = info["bestblockhash"]
+        self.mediantime = info.get("mediantime")
+        self.updated = time.time()
+        if changed:
+            #the next tip is now least likely to be soon, but actions
+            #following this one are; poll again at the minimum interval.
+            self.loop.reset()
+            for listener in self.listeners[:]:
+                listener.notify()
+
+    def update_failed(self, failure):
+        self.updating = False
+        cslog.info("Failed to update chain tip: " + str(failure.value))
+
+class HeightScheduler(NotifiedService):
+    """Calls back when the chain reaches a block height, e.g. for
+    backouts waiting for a locktime to expire. Checks read the cached
+    ChainTip, and are made when it changes, so there are no RPC calls
+    between blocks however many sessions are waiting.
+    """
+    def call_at_height(self, height, callback, *args):
+        """callback(*args) is called once the current block height
+        is at least height. Returns an id for cancel().
+        """
+        return self.add_waiter((height, callback, args))
+
+    def check_waiters(self):
+        tip = get_chain_tip().height
+        for waiter_id, (height, callback, args) in sorted(
+            self.waiters.items(), key=lambda x: x[1][0]):
+            if height > tip:
+                break
+            if waiter_id not in self.waiters:
+                continue
+            del self.waiters[waiter_id]
+            callback(*args)
+
+def get_confirmation_notifier():
+    if not cs_single().confirmation_notifier:
+        cs_single().confirmation_notifier = ConfirmationNotifier()
+    return cs_single().confirmation_notifier
+
+def get_height_scheduler():
+    if not cs_single().height_scheduler:
+        cs_single().height_scheduler = HeightScheduler()
+    return cs_single().height_scheduler
+
+def get_chain_tip():
+    """The process-wide ChainTip, started on first use; new tips also
+    trigger checks of waiting confirmations and block heights.
+    """
+    if not cs_single().chain_tip:
+        tip = ChainTip()
+        tip.listeners = [get_confirmation_notifier(), get_height_scheduler()]
+        cs_single().chain_tip = tip
+        tip.start()
+    return cs_single().chain_tip
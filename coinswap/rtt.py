@@ -0,0 +1,122 @@
+from __future__ import print_function
+"""Timeouts for waiting on the counterparty, learned from the response
+times observed, instead of the fixed default_network_timeout.
+"""
+
+import json
+import os
+import threading
+from collections import deque
+from twisted.internet import reactor, threads
+from .configure import get_log, cs_single
+
+cslog = get_log()
+
+#the number of most recent samples kept for each key
+RTT_WINDOW = 100
+#below this many samples, default_network_timeout is used
+RTT_MIN_SAMPLES = 5
+#seconds after a new sample before saving, so that a burst is saved once
+RTT_SAVE_DELAY = 10.0
+
+def get_rtt_file():
+    return os.path.join(cs_single().homedir, "rtt_samples.json")
+
+class RTTEstimator(object):
+    """Response times (seconds) observed for one key, i.e. one server
+    (as client) or one transport (as server), and the network timeout
+    derived from them: network_timeout_factor times their
+    network_timeout_percentile'th percentile, bounded by
+    network_timeout_floor and network_timeout_ceiling (config TIMEOUT
+    section). Samples are saved in the home directory (see RTTSampleFile),
+    so that a client, which runs one coinswap per process, learns across
+    runs.
+    """
+    def __init__(self, key, samples=None):
+        self.key = key
+        self.samples = deque(samples if samples else [], maxlen=RTT_WINDOW)
+
+    def add(self, rtt):
+        self.samples.append(rtt)
+        get_rtt_sample_file().schedule_save()
+
+    def percentile(self, p):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+    def get_timeout(self):
+        c = cs_single().config
+        if len(self.samples) < RTT_MIN_SAMPLES:
+            return c.getfloat("TIMEOUT", "default_network_timeout")
+        timeout = c.getfloat("TIMEOUT", "network_timeout_factor") * \
+                  self.percentile(c.getfloat("TIMEOUT",
+                                             "network_timeout_percentile"))
+        return min(max(timeout, c.getfloat("TIMEOUT", "network_timeout_floor")),
+                   c.getfloat("TIMEOUT", "network_timeout_ceiling"))
+
+class RTTSampleFile(object):
+    """The file of samples of every RTTEstimator, keyed as they are.
+    Saving is done RTT_SAVE_DELAY seconds after a new sample, and on
+    reactor shutdown, in a thread; the samples are merged into those
+    in the file, since a server and a client sharing a home directory
+    (whose keys differ) both save there.
+    """
+    def __init__(self, location):
+        self.location = location
+        self.save_call = None
+        #serializes the threads' read, merge and write
+        self.lock = threading.Lock()
+        reactor.addSystemEventTrigger("before", "shutdown", self.flush)
+
+    def load(self):
+        try:
+            with open(self.location, "rb") as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def schedule_save(self):
+        if not (self.save_call and self.save_call.active()):
+            self.save_call = reactor.callLater(RTT_SAVE_DELAY, self.save)
+
+    def flush(self):
+        """Save now if a save is scheduled; returns a Deferred if so,
+        which reactor shutdown waits for.
+        """
+        if self.save_call and self.save_call.active():
+            self.save_call.cancel()
+            return self.save()
+
+    def save(self):
+        self.save_call = None
+        samples = dict([(k, list(e.samples)) for k, e in
+                        cs_single().rtt_estimators.iteritems()])
+        d = threads.deferToThread(self.write, samples)
+        d.addErrback(lambda f: cslog.info("Failed to save response times: " +
+                                          repr(f.value)))
+        return d
+
+    def write(self, samples):
+        with self.lock:
+            merged = self.load()
+            merged.update(samples)
+            with open(self.location + ".tmp", "wb") as f:
+                f.write(json.dumps(merged))
+            os.rename(self.location + ".tmp", self.location)
+
+def get_rtt_sample_file():
+    if not cs_single().rtt_sample_file:
+        cs_single().rtt_sample_file = RTTSampleFile(get_rtt_file())
+    return cs_single().rtt_sample_file
+
+def get_rtt_estimator(key):
+    """The process-wide RTTEstimator for key; on first use, all keys'
+    saved samples are loaded.
+    """
+    if cs_single().rtt_estimators is None:
+        cs_single().rtt_estimators = dict([(k, RTTEstimator(k, v)) for k, v in
+                                           get_rtt_sample_file().load(
+                                               ).iteritems()])
+    if key not in cs_single().rtt_estimators:
+        cs_single().rtt_estimators[key] = RTTEstimator(key)
+    return cs_single().rtt_estimators[key]
@@ -0,0 +1,450 @@
+from __future__ import print_function
+"""Scanning of the blockchain for coinswap secrets; this is only needed
+by Carol, in backout cases where the transaction redeeming TX3 via the
+secret was not seen by the wallet monitoring.
+"""
+
+import binascii
+import copy
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+import jmbitcoin as btc
+from twisted.internet import reactor, threads, defer
+from .configure import get_log, cs_single
+from .base import (COINSWAP_SECRET_ENTROPY_BYTES,
+                   ESCROW_REDEEM_SCRIPT_PREFIX)
+from .blockcache import get_block_cache
+from .notify import get_chain_tip
+
+cslog = get_log()
+
+#Each fetching thread uses its own copy of the RPC connection object.
+_thread_data = threading.local()
+
+def get_thread_rpc():
+    if not hasattr(_thread_data, "rpc"):
+        _thread_data.rpc = copy.copy(cs_single().bc_interface.jsonRpc)
+    return _thread_data.rpc
+
+def find_preimages_in_rawblock(rawblock):
+    """Returns a dict of hash160 : preimage (both hex) for every
+    coinswap secret revealed in the binary block (or transaction)
+    rawblock.
+    Rather than deserializing every transaction, we search the raw bytes
+    for the start of the escrow redeem script, which is pushed last in
+    the scriptSig of any spend out of TX2/TX3, and only decode the
+    scriptSig around those matches: in a secret redeem the redeem script
+    push is preceded by a push of exactly COINSWAP_SECRET_ENTROPY_BYTES,
+    whose hash160 must be the one committed to in the script itself.
+    Almost all blocks contain no match, so the scan cost is that of the
+    byte search.
+    """
+    found = {}
+    pos = rawblock.find(ESCROW_REDEEM_SCRIPT_PREFIX)
+    while pos != -1:
+        hashed = rawblock[pos + len(ESCROW_REDEEM_SCRIPT_PREFIX):
+                          pos + len(ESCROW_REDEEM_SCRIPT_PREFIX) + 20]
+        #the redeem script is pushed with OP_PUSHDATA1 (being over 75 bytes)
+        pushstart = pos - 2 if rawblock[pos - 2] == "\x4c" else pos - 1
+        secretstart = pushstart - COINSWAP_SECRET_ENTROPY_BYTES
+        if secretstart >= 1 and rawblock[secretstart - 1] == chr(
+            COINSWAP_SECRET_ENTROPY_BYTES):
+            candidate = rawblock[secretstart:pushstart]
+            if btc.bin_hash160(candidate) == hashed:
+                found[binascii.hexlify(hashed)] = binascii.hexlify(candidate)
+        pos = rawblock.find(ESCROW_REDEEM_SCRIPT_PREFIX, pos + 1)
+    return found
+
+def find_outpoint_spender(utxo, count=100):
+    """Runs in a thread; returns the serialized transaction spending
+    utxo (txid:n) if it is spent and the spend is one of the last count
+    transactions known to our Bitcoin Core wallet (as spends of imported,
+    watch-only addresses are), else None. This needs no block reads;
+    only watch-only sends newer than the transaction creating utxo are
+    candidates, each costing one RPC call.
+    """
+    rpc = get_thread_rpc()
+    txid, n = utxo.split(":")
+    if rpc.call("gettxout", [txid, int(n), True]):
+        #unspent (mempool spends included)
+        return None
+    seen = set()
+    for entry in reversed(rpc.call("listtransactions", ["*", count, 0, True])):
+        if entry["txid"] == txid:
+            #any spend was added to the wallet after this
+            break
+        if not entry.get("involvesWatchonly") or entry.get(
+            "category") != "send" or entry["txid"] in seen:
+            continue
+        seen.add(entry["txid"])
+        rawtx = rpc.call("gettransaction", [entry["txid"], True])["hex"]
+        for inp in btc.deserialize(rawtx)["ins"]:
+            if inp["outpoint"]["hash"] == txid and \
+               inp["outpoint"]["index"] == int(n):
+                return rawtx
+    return None
+
+class SecretScanner(object):
+    """Scans blocks for the preimages of a set of hashed secrets, each
+    wanted over its own ranges of block heights. Each block is fetched
+    and parsed once, however many secrets are wanted from it, and each
+    candidate push is matched against all of them with a set lookup.
+    Blocks are fetched with a bounded number of concurrent RPC calls, and
+    searched by the fetching threads, since the search (a byte search, see
+    find_preimages_in_rawblock) costs little next to the fetch; the scan
+    stops as soon as all the secrets are found.
+    If progress_callback is set, it is called (from a pool thread) with
+    the set of heights parsed so far, every checkpoint_interval blocks.
+    """
+    checkpoint_interval = 10
+
+    def __init__(self, wanted, rpc_concurrency=None, progress_callback=None):
+        c = cs_single().config
+        #hashed secret : [(lowest height, highest height), ..]
+        self.wanted = wanted
+        if rpc_concurrency is None:
+            rpc_concurrency = c.getint("SERVER", "secret_scan_rpc_concurrency")
+        self.rpc_concurrency = max(rpc_concurrency, 1)
+        #hashed secret : preimage
+        self.secrets = {}
+        self.found = threading.Event()
+        self.lock = threading.Lock()
+        self.progress_callback = progress_callback
+        #heights of all blocks parsed (and so checked for every secret)
+        self.parsed = set()
+
+    def get_heights(self):
+        """The union of all wanted ranges, most recent first,
+        as the redeem is most likely to be recent.
+        """
+        heights = set()
+        for ranges in self.wanted.values():
+            for lo, hi in ranges:
+                heights.update(range(lo, hi + 1))
+        return sorted(heights, reverse=True)
+
+    def fetch_block(self, height):
+        """Runs in a fetching thread; returns the height and the preimages
+        found in the block at that height, which are None if the block
+        was not retrieved.
+        """
+        if self.found.is_set():
+            return (height, None)
+        try:
+            rawblock = get_block_cache().get_rawblock(height, get_thread_rpc())
+        except Exception as e:
+            cslog.info("Failed to retrieve block at height: " + str(
+                height) + ", error: " + repr(e))
+            return (height, None)
+        return (height, find_preimages_in_rawblock(rawblock))
+
+    def on_parsed(self, result):
+        height, preimages = result
+        with self.lock:
+            for h in set(preimages.keys()).intersection(self.wanted.keys()):
+                if h not in self.secrets:
+                    cslog.info("Found secret in block: " + str(height))
+                    self.secrets[h] = preimages[h]
+            if len(self.secrets) == len(self.wanted):
+                self.found.set()
+            self.parsed.add(height)
+            checkpoint = len(self.parsed) % self.checkpoint_interval == 0
+            parsed = set(self.parsed)
+        if checkpoint and self.progress_callback:
+            self.progress_callback(parsed)
+
+    def scan(self):
+        """Blocking; returns a dict of hashed secret : preimage
+        for each of the wanted secrets that was found.
+        """
+        get_block_cache().sync_tip(get_thread_rpc())
+        fetchers = ThreadPool(self.rpc_concurrency)
+        try:
+            for height, preimages in fetchers.imap_unordered(self.fetch_block,
+                                                        self.get_heights()):
+                if preimages is not None:
+                    self.on_parsed((height, preimages))
+                if self.found.is_set():
+                    break
+        finally:
+            fetchers.terminate()
+            fetchers.join()
+        return self.secrets
+
+def ranges_cover(outer, inner):
+    """True if each of the height ranges inner is within one of
+    the ranges outer.
+    """
+    return all([any([lo <= a and b <= hi for lo, hi in outer])
+                for a, b in inner])
+
+class SecretScanCoordinator(object):
+    """Collects the secret scan requests made by all sessions (e.g.
+    several Carols backing out after a restart) and serves them with
+    a single SecretScanner run in a thread, so the cost is proportional
+    to the number of blocks, not blocks times sessions. Only one scan
+    runs at a time: a request for a secret already being scanned for
+    over its ranges joins that scan, and any others are queued and run
+    together when it finishes (mostly reading blocks from the cache).
+    """
+    def __init__(self):
+        #hashed secret : [[(lowest height, highest height), ..],
+        #                 [deferreds], [progress callbacks]]
+        self.pending = {}
+        self.scheduled = False
+        #as pending, for the scan running
+        self.running = None
+
+    def request(self, hashed_secret, ranges, progress_callback=None):
+        """Returns a Deferred which fires with the preimage of
+        hashed_secret, or None if it was not found in the blocks
+        in ranges, a list of (lowest height, highest height).
+        progress_callback, if set, is called on the reactor thread
+        with the set of heights scanned, during and after the scan.
+        """
+        d = defer.Deferred()
+        if self.running and hashed_secret in self.running and ranges_cover(
+            self.running[hashed_secret][0], ranges):
+            p = self.running[hashed_secret]
+        else:
+            if hashed_secret not in self.pending:
+                self.pending[hashed_secret] = [[], [], []]
+            p = self.pending[hashed_secret]
+            p[0].extend(ranges)
+            self.schedule_scan()
+        p[1].append(d)
+        if progress_callback:
+            p[2].append(progress_callback)
+        return d
+
+    def schedule_scan(self):
+        if not self.scheduled and not self.running:
+            self.scheduled = True
+            reactor.callLater(0, self.run_scan)
+
+    def run_scan(self):
+        self.scheduled = False
+        batch, self.pending = self.pending, {}
+        self.running = batch
+        wanted = dict([(h, v[0]) for h, v in batch.iteritems()])
+        cslog.info("Scanning blockchain for " + str(len(wanted)) + \
+                   " coinswap secret(s).")
+        scanner = SecretScanner(wanted, progress_callback=lambda heights:
+                                reactor.callFromThread(self.scan_progress,
+                                                       heights, batch))
+        d = threads.deferToThread(scanner.scan)
+        d.addCallback(self.scan_complete, batch, scanner)
+        d.addErrback(self.scan_failed, batch, scanner)
+
+    def scan_progress(self, heights, batch):
+        for h, v in batch.iteritems():
+            for callback in v[2]:
+                callback(heights)
+
+    def scan_complete(self, secrets, batch, scanner):
+        self.running = None
+        self.scan_progress(scanner.parsed, batch)
+        for h, v in batch.iteritems():
+            for d in v[1]:
+                d.callback(secrets.get(h))
+        if self.pending:
+            self.schedule_scan()
+
+    def scan_failed(self, failure, batch, scanner):
+        cslog.info("Secret scan failed: " + str(failure.value))
+        self.scan_complete({}, batch, scanner)
+
+def get_secret_scan_coordinator():
+    if not cs_single().secret_scan_coordinator:
+        cs_single().secret_scan_coordinator = SecretScanCoordinator()
+    return cs_single().secret_scan_coordinator
+
+class SecretIndex(object):
+    """A persistent map of hash160 to preimage for every
+    coinswap secret revealed on the blockchain, covering a contiguous
+    range of blocks from start_height to tip_height. It is kept up
+    to date by a SecretIndexFollower, so that looking up a hashed
+    secret does not require any block scanning.
+    Stored as json in the server's home directory.
+    """
+    #how many recent block hashes to keep for reorg detection
+    reorg_depth = 100
+
+    def __init__(self, location):
+        self.location = location
+        self.start_height = None
+        self.tip_height = None
+        self.recent_hashes = {}
+        #hash160 : [preimage, height]
+        self.preimages = {}
+        if os.path.exists(self.location):
+            self.load()
+
+    def load(self):
+        with open(self.location, "rb") as f:
+            d = json.loads(f.read())
+        self.start_height = d["start_height"]
+        self.tip_height = d["tip_height"]
+        self.recent_hashes = dict([(int(k), str(v)) for k, v in d[
+            "recent_hashes"].iteritems()])
+        self.preimages = dict([(str(k), [str(v[0]), v[1]]) for k, v in d[
+            "preimages"].iteritems()])
+
+    def persist(self):
+        d = {"start_height": self.start_height,
+             "tip_height": self.tip_height,
+             "recent_hashes": self.recent_hashes,
+             "preimages": self.preimages}
+        #write then rename, so a crash never leaves a truncated index
+        with open(self.location + ".tmp", "wb") as f:
+            f.write(json.dumps(d))
+        os.rename(self.location + ".tmp", self.location)
+
+    def lookup(self, hashed_secret):
+        if hashed_secret in self.preimages:
+            return self.preimages[hashed_secret][0]
+        return None
+
+    def covers(self, height):
+        if self.tip_height is None:
+            return False
+        return self.start_height <= height <= self.tip_height
+
+    def get_tip_hash(self):
+        return self.recent_hashes.get(self.tip_height)
+
+    def add_block(self, height, blockhash, preimages):
+        """Add the preimages found in the block at height; blocks
+        must be added in order.
+        """
+        if self.tip_height is None:
+            self.start_height = height
+        else:
+            assert height == self.tip_height + 1
+        for h, p in preimages.iteritems():
+            self.preimages[h] = [p, height]
+        self.tip_height = height
+        self.recent_hashes[height] = blockhash
+        self.recent_hashes.pop(height - self.reorg_depth, None)
+
+    def rewind(self):
+        """Remove the tip block from the index (in a reorg).
+        """
+        self.preimages = dict([(k, v) for k, v in self.preimages.iteritems(
+            ) if v[1] < self.tip_height])
+        self.recent_hashes.pop(self.tip_height, None)
+        self.tip_height -= 1
+        if self.tip_height < self.start_height or not self.get_tip_hash():
+            #reorg deeper than we can track; start over.
+            cslog.info("Secret index cannot follow reorg, rebuilding.")
+            self.start_height = None
+            self.tip_height = None
+            self.recent_hashes = {}
+            self.preimages = {}
+
+class SecretIndexFollower(object):
+    """Follows the chain tip and adds each new block to a SecretIndex.
+    It is a ChainTip listener, so it updates when a block arrives (by
+    notification or the ChainTip's own poll), and keeps updating until
+    the index reaches the tip. Fetching and parsing of blocks is done in
+    a thread; the index itself is only updated on the reactor thread.
+    """
+    #maximum number of blocks processed per update, so that the initial
+    #catch-up does not hold a thread for too long.
+    batch_size = 20
+
+    def __init__(self, index, lookback):
+        self.index = index
+        #how far before the current tip to start an empty index
+        self.lookback = lookback
+        self.updating = False
+        #a new tip was notified during an update
+        self.update_pending = False
+        #Deferreds waiting for the index to reach the tip
+        self.catch_up_waiters = []
+
+    def start(self):
+        get_chain_tip().listeners.append(self)
+        self.update()
+
+    def stop(self):
+        if self in get_chain_tip().listeners:
+            get_chain_tip().listeners.remove(self)
+
+    def notify(self):
+        self.update()
+
+    def when_caught_up(self):
+        """Returns a Deferred which fires once an update has brought the
+        index up to the chain tip (or failed).
+        """
+        d = defer.Deferred()
+        self.catch_up_waiters.append(d)
+        return d
+
+    def caught_up(self):
+        waiters, self.catch_up_waiters = self.catch_up_waiters, []
+        for d in waiters:
+            d.callback(self.index.tip_height)
+
+    def fetch_blocks(self, next_height):
+        """Runs in a thread; returns the current tip height, and a list of
+        (height, blockhash, previous blockhash, preimages) for blocks from
+        next_height up to at most batch_size blocks, ending at the tip.
+        """
+        rpc = get_thread_rpc()
+        cache = get_block_cache()
+        cache.sync_tip(rpc)
+        tip = rpc.call("getblockcount", [])
+        if next_height is None:
+            next_height = max(tip - self.lookback, 0)
+        blocks = []
+        for height in range(next_height, min(tip, next_height +
+                                             self.batch_size - 1) + 1):
+            blockhash = cache.get_block_hash(height, rpc)
+            rawblock = cache.get_rawblock_by_hash(blockhash, rpc)
+            prevhash = binascii.hexlify(rawblock[4:36][::-1])
+            blocks.append((height, blockhash, prevhash,
+                           find_preimages_in_rawblock(rawblock)))
+        return (tip, blocks)
+
+    def update(self):
+        if self.updating:
+            self.update_pending = True
+            return
+        self.updating = True
+        self.update_pending = False
+        next_height = None if self.index.tip_height is None else \
+            self.index.tip_height + 1
+        d = threads.deferToThread(self.fetch_blocks, next_height)
+        d.addCallback(self.apply_blocks)
+        d.addErrback(self.update_failed)
+
+    def apply_blocks(self, result):
+        self.updating = False
+        tip, blocks = result
+        for height, blockhash, prevhash, preimages in blocks:
+            if self.index.tip_height is not None and (
+                height != self.index.tip_height + 1 or
+                prevhash != self.index.get_tip_hash()):
+                cslog.info("Secret index detected reorg at height: " + str(
+                    height))
+                self.index.rewind()
+                break
+            self.index.add_block(height, blockhash, preimages)
+        if blocks:
+            self.index.persist()
+        if self.update_pending or self.index.tip_height is None or \
+           self.index.tip_height < tip:
+            #further behind than one batch, rewound, or a new block
+            self.update()
+        else:
+            self.caught_up()
+
+    def update_failed(self, failure):
+        self.updating = False
+        cslog.info("Failed to update secret index: " + str(failure.value))
+        #don't hold up those waiting; they can fall back to scanning
+        self.caught_up()
@@ -1,15 +1,88 @@
 from __future__ import print_function
-from .configure import get_log
-from twisted.internet import reactor
+import bisect
+import time
+from .configure import get_log, cs_single
+from twisted.internet import reactor, defer
 
 cslog = get_log()
 
+#upper bounds (seconds) of the buckets of a LatencyHistogram; the last
+#bucket counts everything longer.
+LATENCY_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 600, 3600]
+
+class LatencyHistogram(object):
+    """Counts of durations in the buckets of LATENCY_BUCKETS,
+    with their total and maximum.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+
+    def count(self):
+        return sum(self.counts)
+
+    def as_dict(self):
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ["inf"]
+        return {"count": self.count(),
+                "mean": self.total / self.count() if self.count() else 0.0,
+                "max": self.maximum,
+                "buckets": zip(bounds, self.counts)}
+
+class StateLatencies(object):
+    """For each state of the state machines of one role, histograms of
+    the time taken executing its transition callback ("exec"), and of
+    the time waited since the previous state completed before the
+    callback was called, e.g. for a message from the counterparty or for
+    a confirmation ("wait"). Aggregated over all sessions in the process.
+    """
+    def __init__(self):
+        #state : {"exec": LatencyHistogram, "wait": LatencyHistogram}
+        self.states = {}
+
+    def record(self, state, kind, duration):
+        if state not in self.states:
+            self.states[state] = {"exec": LatencyHistogram(),
+                                  "wait": LatencyHistogram()}
+        self.states[state][kind].add(duration)
+
+    def as_dict(self):
+        return dict([(state, dict([(k, h.as_dict()) for k, h in d.iteritems()]))
+                     for state, d in self.states.iteritems()])
+
+    def summary(self):
+        """One line of text per state, for reports.
+        """
+        lines = []
+        for state in sorted(self.states):
+            e, w = self.states[state]["exec"], self.states[state]["wait"]
+            line = "State " + str(state) + ": exec mean/max %.3f/%.3fs" % (
+                e.total / e.count() if e.count() else 0.0, e.maximum)
+            if w.count():
+                line += ", wait mean/max %.3f/%.3fs" % (w.total / w.count(),
+                                                        w.maximum)
+            lines.append(line + " (" + str(e.count()) + " runs)")
+        return lines
+
+def get_state_latencies(role):
+    """The process-wide StateLatencies for role ("Alice" or "Carol").
+    """
+    if role not in cs_single().state_latencies:
+        cs_single().state_latencies[role] = StateLatencies()
+    return cs_single().state_latencies[role]
+
 class StateMachine(object):
     """A simple state machine that has integer states,
     incremented on successful execution of corresponding callbacks.
     See docs/state-machine.md for details and rationale.
     """
-    def __init__(self, init_state, backout, callbackdata, default_timeout):
+    def __init__(self, init_state, backout, callbackdata, default_timeout,
+                 role=None):
         self.num_states = len(callbackdata)
         self.init_state = init_state
         self.state = init_state
@@ -20,6 +93,18 @@ class StateMachine(object):
         #callback, as a lock to prevent multiple executions.
         self.state_in_process = False
         self.default_timeout = default_timeout
+        #the pending stallMonitor call (a DelayedCall), if any
+        self.stall_monitor = None
+        #(state, start time, end time, outcome) for each transition attempted
+        self.trace = []
+        #latencies are recorded in get_state_latencies(role), if set
+        self.latencies = get_state_latencies(role) if role else None
+        #the time the last state completed
+        self.last_completed = None
+        #states waiting for an immediate response from the counterparty,
+        #which use the default timeout, or one from rtt_estimator if set
+        self.network_states = set()
+        self.rtt_estimator = None
         #by default no pre- or post- processing
         self.setup = None
         self.finalize = None
@@ -35,11 +120,42 @@ class StateMachine(object):
                 self.timeouts.append(cbd[2])
             else:
                 self.timeouts.append(self.default_timeout)
+                self.network_states.add(i)
+
+    def set_stall_monitor(self):
+        """Replace any pending stallMonitor call with one for the
+        current state.
+        """
+        self.cancel_stall_monitor()
+        if self.state < len(self.callbacks):
+            self.stall_monitor = reactor.callLater(self.get_timeout(self.state),
+                                                   self.stallMonitor,
+                                                   self.state)
+
+    def set_rtt_estimator(self, estimator):
+        """Use estimator (see rtt.RTTEstimator) to set the timeouts of the
+        network states, and give it the response times observed in them.
+        """
+        self.rtt_estimator = estimator
+
+    def get_timeout(self, state):
+        if self.rtt_estimator and state in self.network_states:
+            return self.rtt_estimator.get_timeout()
+        return self.timeouts[state]
+
+    def cancel_stall_monitor(self):
+        """Called on each state change, and when the session ends, so
+        that no timers are left in the reactor.
+        """
+        if self.stall_monitor and self.stall_monitor.active():
+            self.stall_monitor.cancel()
+        self.stall_monitor = None
 
     def stallMonitor(self, state):
         """Wakes up a set timeout after state transition callback
         was called; if state has not been incremented, we backout.
         """
+        self.stall_monitor = None
         if state < self.state or self.state == len(self.callbacks):
             return
         if not self.freeze:
@@ -53,64 +169,141 @@ class StateMachine(object):
         counterparty, these are provided, otherwise not.
         Calls backout_callback on failure, to allow
         the caller to execute backout conditional on state.
+        Callbacks may return a Deferred (firing with (retval, msg)) instead
+        of (retval, msg); the processing lock is then held until it fires,
+        and a Deferred firing with the result of the tick is returned.
         """
         if self.state_in_process:
             cslog.info("Attempted to tick forward state but still in process, ignoring.")
             return (False, "Attempted to tick forward state but still in process, ignoring.")
         self.state_in_process = True
-        if self.freeze:
-            cslog.info("State machine is shut down, no longer receiving updates")
-            return (False, "State machine is shut down, no longer receiving updates")
-        if self.state == len(self.callbacks):
-            cslog.info("State machine has completed.")
-            return (False, "State machine has completed.")
-        cslog.info("starting tick function, state is: " + str(self.state))     
+        return self.run_states(args)
+
+    def run_states(self, args):
+        """Executes the current state's callback, and then those of any
+        following auto_continue states, in a loop; returns the result
+        of the last, or a Deferred if a callback returned one, in which
+        case the loop is resumed when it fires.
+        """
+        while True:
+            if self.freeze:
+                cslog.info("State machine is shut down, no longer receiving updates")
+                return (False, "State machine is shut down, no longer receiving updates")
+            if self.state == len(self.callbacks):
+                cslog.info("State machine has completed.")
+                return (False, "State machine has completed.")
+            result = self.run_state(*args)
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(self.resume_states)
+            if not self.continues(result):
+                return result
+            self.state_in_process = True
+            args = ()
+
+    def run_state(self, *args):
+        """Runs the current state's callback and completes the state's
+        processing; returns the result, or a Deferred firing with it.
+        Every state run, including auto_continue ones, goes through here,
+        so subclasses can intercept it (see test/bad_state_machine.py).
+        """
+        cslog.info("starting tick function, state is: %d", self.state)
+        started = time.time()
         if self.setup:
             self.setup()
-        if not args:
-            retval, msg = self.execute_callback()
-        else:
-            retval, msg = self.execute_callback(*args)
+        result = self.execute_callback(*args)
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(self.complete_state, started)
+        return self.complete_state(result, started)
+
+    def continues(self, result):
+        return result[0] and self.state in self.auto_continue
+
+    def resume_states(self, result):
+        if not self.continues(result):
+            return result
+        self.state_in_process = True
+        return self.run_states(())
+
+    def complete_state(self, result, started):
+        """The remainder of a state's processing, once its transition
+        callback has returned its result. A result arriving after the
+        state machine was frozen (backout, or a stall timeout while a
+        Deferred was pending) is dropped: the state is not completed.
+        """
+        if self.freeze:
+            cslog.info("Dropping result for state: %d, state machine is "
+                       "shut down.", self.state)
+            return (False, "State machine is shut down, result dropped.")
+        retval, msg = result
+        state = self.state - 1 if retval else self.state
+        completed = time.time()
+        self.trace.append((state, started, completed, msg))
+        if self.latencies:
+            self.latencies.record(state, "exec", completed - started)
+            if self.last_completed:
+                self.latencies.record(state, "wait",
+                                      started - self.last_completed)
+        #the wait for a network state not run automatically is the time
+        #taken by the counterparty to respond
+        if retval and self.rtt_estimator and self.last_completed and \
+           state in self.network_states and state not in self.auto_continue:
+            self.rtt_estimator.add(started - self.last_completed)
         if not retval:
-            cslog.info("Execution failed at step after: " + str(self.state) + \
-                  ", backing out.")
-            cslog.info("Error message: " + msg)
+            cslog.info("Execution failed at step after: %d, backing out.",
+                       self.state)
+            cslog.info("Error message: %s", msg)
             #state machine must lock and prevent update from counterparty
             #at point of backout.
             self.freeze = True
+            self.cancel_stall_monitor()
             reactor.callLater(0, self.backout_callback, msg)
             return (False, msg)
         if self.finalize:
             if self.state > 2:
                 self.finalize()
-        cslog.info("State: " + str(self.state -1) + " finished OK.")
+        cslog.info("State: %d finished OK.", state)
         #create a monitor call that's woken up after timeout; if we didn't
         #update, something is wrong, so backout
-        if self.state < len(self.callbacks):
-            reactor.callLater(self.timeouts[self.state],
-                              self.stallMonitor, self.state)
+        self.set_stall_monitor()
+        self.last_completed = completed
         self.state_in_process = False
-        if self.state in self.auto_continue:
-            return self.tick()
         return (retval, msg)
 
+    def get_trace(self):
+        """The record of each state transition attempted in this session,
+        as a list of dicts of: state, start and end (unix times) and
+        outcome ("OK" or the error message), for export.
+        """
+        return [{"state": t[0], "start": t[1], "end": t[2], "outcome": t[3]}
+                for t in self.trace]
+
     def execute_callback(self, *args):
         try:
-            if args:
-                retval, msg = self.callbacks[self.state](*args)
-            else:
-                retval, msg = self.callbacks[self.state]()
+            result = self.callbacks[self.state](*args)
         except Exception as e:
-            errormsg = "Failure to execute step after: " + str(self.state)
-            errormsg += ", Exception: " + repr(e)
-            cslog.info(errormsg)
-            return (False, errormsg)
+            return self.callback_failed(e)
+        if isinstance(result, defer.Deferred):
+            return result.addCallbacks(self.callback_returned,
+                                       lambda f: self.callback_failed(f.value))
+        return self.callback_returned(result)
+
+    def callback_returned(self, result):
+        if self.freeze:
+            #too late; the state must not be advanced
+            return (False, "State machine is shut down, result dropped.")
+        retval, msg = result
         if not retval:
             return (False, msg)
         #update to next state *only* on success.
         self.state += 1
         return (retval, "OK")
 
+    def callback_failed(self, e):
+        errormsg = "Failure to execute step after: " + str(self.state)
+        errormsg += ", Exception: " + repr(e)
+        cslog.info(errormsg)
+        return (False, errormsg)
+
     def set_finalize(self, callback):
         self.finalize = callback
 
@@ -123,4 +316,5 @@ class StateMachine(object):
         to a negotiation with the counterparty.
         """
         for s in states:
-            self.timeouts[s] = timeout
\ No newline at end of file
+            self.timeouts[s] = timeout
+            self.network_states.discard(s)
\ No newline at end of file
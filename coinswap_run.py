@@ -8,7 +8,10 @@ from jmbase.support import get_password
 from coinswap import (cs_single, CoinSwapPublicParameters, CoinSwapAlice,
                       CoinSwapCarol, CoinSwapJSONRPCClient,
                       get_current_blockheight, get_log, load_coinswap_config,
-                      get_coinswap_parser, CoinSwapCarolJSONServer, start_tor)
+                      get_coinswap_parser, CoinSwapCarolJSONServer, start_tor,
+                      SecretIndex, SecretIndexFollower, ChainNotifyResource,
+                      get_confirmation_notifier, get_chain_tip,
+                      get_keypair_pool, SizeLimitedRequest)
 
 from twisted.internet import reactor
 try:
@@ -65,12 +68,47 @@ def get_ssl_context():
     return ssl.DefaultOpenSSLContextFactory(pkcdata["ssl_private_key_location"],
                                             pkcdata["ssl_certificate_location"])
 
+def start_secret_index():
+    """Load the server's index of revealed coinswap secrets and
+    start following new blocks to keep it up to date; returns the
+    SecretIndexFollower.
+    """
+    cs_single().secret_index = SecretIndex(os.path.join(cs_single().homedir,
+                                                        "secretindex.json"))
+    clientlockrange = cs_single().config.get("SERVER", "client_locktime_range")
+    lookback = max([int(x) for x in clientlockrange.split(",")])
+    follower = SecretIndexFollower(cs_single().secret_index, lookback)
+    reactor.callWhenRunning(follower.start)
+    return follower
+
+def start_chain_notify():
+    """Listen (locally only) for bitcoind's block and wallet notifications,
+    if configured. Only listens once per process, e.g. when running
+    both the server and a client.
+    """
+    if cs_single().chain_notify_port:
+        return
+    notify_port = cs_single().config.getint("BLOCKCHAIN", "chain_notify_port")
+    if not notify_port:
+        return
+    #a new tip notifies the other services in turn.
+    block_listeners = [get_chain_tip()]
+    tx_listeners = [get_confirmation_notifier()]
+    cs_single().chain_notify_port = reactor.listenTCP(notify_port,
+        server.Site(ChainNotifyResource(block_listeners, tx_listeners)),
+        interface="127.0.0.1")
+
 def main_server(options, wallet, test_data=None):
     """The use_ssl option is only for tests, and flags that case.
     """
     if test_data and not test_data['use_ssl']:
         cs_single().config.set("SERVER", "use_ssl", "false")
     cs_single().bc_interface.start_unspent_monitoring(wallet)
+    get_keypair_pool().start()
+    start_chain_notify()
+    follower = None
+    if cs_single().config.get("SERVER", "use_secret_index") != "false":
+        follower = start_secret_index()
     #to allow testing of confirm/unconfirm callback for multiple txs
     if isinstance(cs_single().bc_interface, RegtestBitcoinCoreInterface):
         cs_single().bc_interface.tick_forward_chain_interval = 2
@@ -84,7 +122,14 @@ def main_server(options, wallet, test_data=None):
         carol = CoinSwapCarol(wallet, 'carolstate')
         carol.bbmb = wallet.get_balance_by_mixdepth(verbose=False)
         carol.load(sessionid=session_id)
-        carol.backout("Recovering from shutdown")
+        if follower:
+            #The index is behind by the blocks missed while shut down;
+            #back out once it has caught up, so the secret, if revealed,
+            #is found in it rather than by scanning.
+            follower.when_caught_up().addCallback(
+                lambda _: carol.backout("Recovering from shutdown"))
+        else:
+            carol.backout("Recovering from shutdown")
         reactor.run()
         return
     #TODO currently ignores server setting here and uses localhost
@@ -98,7 +143,8 @@ def main_server(options, wallet, test_data=None):
         s = server.Site(CoinSwapCarolJSONServer(wallet,
                                                     testing_mode=testing_mode,
                                                     carol_class=carol_class,
-                                                    fail_carol_state=fcs))
+                                                    fail_carol_state=fcs),
+                        requestFactory=SizeLimitedRequest)
         hiddenservice_dir = os.path.join(cs_single().homedir, "hiddenservice")
         if not os.path.exists(hiddenservice_dir):
             os.makedirs(hiddenservice_dir)
@@ -110,13 +156,15 @@ def main_server(options, wallet, test_data=None):
     elif cs_single().config.get("SERVER", "use_ssl") != "false":
         reactor.listenSSL(int(port), server.Site(CoinSwapCarolJSONServer(wallet,
                 testing_mode=testing_mode, carol_class=carol_class,
-                fail_carol_state=fcs)), contextFactory = get_ssl_context())
+                fail_carol_state=fcs), requestFactory=SizeLimitedRequest),
+                contextFactory = get_ssl_context())
     else:
         cslog.info("WARNING! Serving over HTTP, no TLS used!")
         reactor.listenTCP(int(port), server.Site(CoinSwapCarolJSONServer(wallet,
                                                     testing_mode=testing_mode,
                                                     carol_class=carol_class,
-                                                    fail_carol_state=fcs)))
+                                                    fail_carol_state=fcs),
+                                          requestFactory=SizeLimitedRequest))
     if not test_data:
         reactor.run()
 
@@ -204,6 +252,7 @@ def main_cs(test_data=None):
         cs_single().config.set("BLOCKCHAIN", "notify_port", "62652")
         cs_single().config.set("BLOCKCHAIN", "rpc_host", "127.0.0.2")
     
+    start_chain_notify()
     #if restart option selected, read state and backout
     if options.recover:
         session_id = options.recover
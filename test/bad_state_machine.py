@@ -12,9 +12,11 @@ class BadStateMachine(StateMachine):
                                               20.0)
         self.fail_state, self.fail_callback = fail_info
 
-    def tick(self, *args):
+    def run_state(self, *args):
+        """Intercepts every state run, whether ticked or auto_continue.
+        """
         if self.state == self.fail_state:
             self.freeze = True
             self.fail_callback()
-        else:
-            return super(BadStateMachine, self).tick(*args)
+            return (False, "Failure injected at state: " + str(self.state))
+        return super(BadStateMachine, self).run_state(*args)
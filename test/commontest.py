@@ -102,3 +102,14 @@ def make_wallets(n,
             #reset the index so the coins can be seen if running in same script
             wallets[i + start_index]['wallet'].index[j][0] -= wallet_structures[i][j]
     return wallets
+
+def set_config_defaults(section, defaults):
+    """For unit tests run without a loaded config: set each (option, value)
+    in defaults in section, unless already set.
+    """
+    c = cs_single().config
+    if not c.has_section(section):
+        c.add_section(section)
+    for option, value in defaults:
+        if not c.has_option(section, option):
+            c.set(section, option, value)
@@ -70,11 +70,13 @@ def teardown():
 @pytest.fixture(scope="session", autouse=True)
 def setup(request):
     print 'starting'
-    request.addfinalizer(teardown)
-
     global bitcoin_conf, bitcoin_path, bitcoin_rpcpassword, bitcoin_rpcusername
     bitcoin_path = request.config.getoption("--btcroot")
     bitcoin_conf = request.config.getoption("--btcconf")
+    if not bitcoin_conf:
+        #unit tests (those not using regtest) can run without bitcoind
+        return
+    request.addfinalizer(teardown)
     bitcoin_rpcpassword = request.config.getoption("--btcpwd")
     bitcoin_rpcusername = request.config.getoption("--btcuser")
 
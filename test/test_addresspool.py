@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of AddressPool, and of Carol's use of it for her destination
+addresses; no bitcoind is needed:
+py.test test_addresspool.py
+"""
+import sys
+import os
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from coinswap import AddressPool, CoinSwapCarol, cs_single
+
+
+class DummyWallet(object):
+    gaplimit = 6
+
+    def __init__(self):
+        self.derived = []
+
+    def get_new_addr(self, mixdepth, branch, import_required):
+        address = "addr_" + str(mixdepth) + "_" + str(branch) + "_" + str(
+            len(self.derived))
+        self.derived.append(address)
+        return address
+
+def refill_all(pool):
+    #the reactor is not running; do the refills it would schedule
+    while any([len(p) < pool.size for p in pool.pools.values()]):
+        pool.refill()
+
+def test_size_kept_below_gap_limit():
+    assert AddressPool(DummyWallet(), 10).size == 5
+    assert AddressPool(DummyWallet(), 4).size == 4
+
+def test_take_from_filled_pool():
+    wallet = DummyWallet()
+    pool = AddressPool(wallet, 3)
+    pool.fill(0, 1)
+    refill_all(pool)
+    assert len(wallet.derived) == 3
+    assert pool.take(0, 1) == wallet.derived[0]
+    #taking does not derive; the refill does
+    assert len(wallet.derived) == 3
+    refill_all(pool)
+    assert len(wallet.derived) == 4
+
+def test_released_address_taken_first():
+    pool = AddressPool(DummyWallet(), 3)
+    pool.fill(0, 1)
+    refill_all(pool)
+    address = pool.take(0, 1)
+    pool.release(0, 1, address)
+    assert pool.take(0, 1) == address
+
+def test_empty_pool_derives_directly():
+    wallet = DummyWallet()
+    pool = AddressPool(wallet, 3)
+    address = pool.take(1, 1)
+    assert address == wallet.derived[-1]
+    assert address.startswith("addr_1_1")
+
+class FakeParameters(object):
+    def __init__(self):
+        self.output_addresses = {"tx5_address": "alice_addr"}
+
+    def set_addr_data(self, addr4=None, addr_2_carol=None, addr_3_carol=None,
+                      addr_5_carol=None):
+        self.output_addresses.update({"tx4_address": addr4,
+                                      "tx2_carol_address": addr_2_carol,
+                                      "tx3_carol_address": addr_3_carol,
+                                      "tx5_carol_address": addr_5_carol})
+
+class FakeStateMachine(object):
+    def __init__(self, state):
+        self.state = state
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = AddressPool(DummyWallet(), 3)
+    for mixdepth, branch in CoinSwapCarol.destination_branches.values():
+        pool.fill(mixdepth, branch)
+    refill_all(pool)
+    monkeypatch.setattr(cs_single(), "address_pool", pool, raising=False)
+    return pool
+
+def make_carol(state):
+    #only the attributes used in reserving and releasing addresses
+    carol = CoinSwapCarol.__new__(CoinSwapCarol)
+    carol.wallet = None
+    carol.coinswap_parameters = FakeParameters()
+    carol.sm = FakeStateMachine(state)
+    carol.long_polls = []
+    carol.confirmation_waits = set()
+    carol.tx1 = None
+    carol.quits = []
+    carol.quit = lambda complete, failed: carol.quits.append((complete, failed))
+    return carol
+
+def destination_addresses(carol):
+    return dict([(k, carol.coinswap_parameters.output_addresses[k]) for k in
+                 CoinSwapCarol.destination_branches])
+
+def test_released_addresses_reused(pool):
+    carol = make_carol(2)
+    carol.reserve_addresses()
+    reserved = destination_addresses(carol)
+    assert len(set(reserved.values())) == len(reserved)
+    carol.release_addresses()
+    assert carol.coinswap_parameters.output_addresses == {
+        "tx5_address": "alice_addr"}
+    carol = make_carol(2)
+    carol.reserve_addresses()
+    #destinations sharing a branch may swap addresses
+    assert set(destination_addresses(carol).values()) == set(
+        reserved.values())
+
+def test_addresses_not_released_once_tx2_signed(pool):
+    for state in [3, 4, 5, 9]:
+        carol = make_carol(state)
+        carol.reserve_addresses()
+        reserved = destination_addresses(carol)
+        carol.release_addresses()
+        assert destination_addresses(carol) == reserved
+        refill_all(pool)
+        carol = make_carol(2)
+        carol.reserve_addresses()
+        assert not set(destination_addresses(carol).values()).intersection(
+            reserved.values())
+
+def test_backout_releases_addresses(pool):
+    carol = make_carol(2)
+    carol.reserve_addresses()
+    reserved = destination_addresses(carol)
+    carol.backout("test", verbose=False)
+    assert carol.quits == [(False, False)]
+    carol = make_carol(2)
+    carol.reserve_addresses()
+    #destinations sharing a branch may swap addresses
+    assert set(destination_addresses(carol).values()) == set(
+        reserved.values())
+
+def test_backout_after_tx2_signed_keeps_addresses(pool):
+    carol = make_carol(3)
+    carol.reserve_addresses()
+    reserved = destination_addresses(carol)
+    carol.backout("test", verbose=False)
+    assert carol.quits == [(False, False)]
+    assert destination_addresses(carol) == reserved
+    carol = make_carol(2)
+    carol.reserve_addresses()
+    assert not set(destination_addresses(carol).values()).intersection(
+        reserved.values())
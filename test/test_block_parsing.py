@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of walking serialized blocks by offset; no bitcoind is needed:
+py.test test_block_parsing.py
+"""
+import sys
+import os
+import struct
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from coinswap.base import read_varint, get_tx_end, iter_block_tx_offsets
+
+
+def ser_varint(n):
+    if n < 253:
+        return struct.pack("<B", n)
+    elif n <= 0xffff:
+        return "\xfd" + struct.pack("<H", n)
+    elif n <= 0xffffffff:
+        return "\xfe" + struct.pack("<I", n)
+    return "\xff" + struct.pack("<Q", n)
+
+def make_tx(scriptsigs, scriptpubkeys, witnesses=None):
+    """A serialized transaction with one input per scriptSig and
+    one output per scriptPubKey; with witnesses (a list of stack
+    items per input), in the segwit serialization.
+    """
+    tx = struct.pack("<I", 2)
+    if witnesses:
+        tx += "\x00\x01"
+    tx += ser_varint(len(scriptsigs))
+    for i, s in enumerate(scriptsigs):
+        tx += chr(i) * 32 + struct.pack("<I", i) + ser_varint(len(s)) + s
+        tx += "\xff" * 4
+    tx += ser_varint(len(scriptpubkeys))
+    for s in scriptpubkeys:
+        tx += struct.pack("<Q", 1000) + ser_varint(len(s)) + s
+    if witnesses:
+        for items in witnesses:
+            tx += ser_varint(len(items))
+            for item in items:
+                tx += ser_varint(len(item)) + item
+    return tx + struct.pack("<I", 0)
+
+def make_block(txs):
+    return "\x00" * 80 + ser_varint(len(txs)) + "".join(txs)
+
+def test_read_varint():
+    for n, size in [(0, 1), (252, 1), (253, 3), (0xffff, 3), (0x10000, 5),
+                    (0xffffffff, 5), (0x100000000, 9)]:
+        data = "\xaa" * 3 + ser_varint(n) + "\xbb"
+        assert read_varint(data, 3) == (n, 3 + size)
+
+def test_get_tx_end_legacy():
+    #a scriptSig long enough for a 3 byte length varint
+    tx = make_tx(["\x51" * 300, "\x52"], ["\x76" * 25, "", "\xa9" * 23])
+    data = "\x99" * 7 + tx + "\x99" * 7
+    assert get_tx_end(data, 7) == 7 + len(tx)
+
+def test_get_tx_end_segwit():
+    tx = make_tx(["", "\x51" * 10], ["\x00" * 22],
+                 [["\x30" * 72, "\x02" * 33], ["", "\x01" * 300, "\x52"]])
+    assert get_tx_end(tx, 0) == len(tx)
+
+def test_get_tx_end_segwit_no_witness_items():
+    tx = make_tx([""], ["\x00" * 34], [[]])
+    assert get_tx_end(tx, 0) == len(tx)
+
+def test_iter_block_tx_offsets():
+    txs = [make_tx(["\x03\x01\x02\x03"], ["\x51"], [["\x00" * 32]]),
+           make_tx(["\x51" * 100], ["\x76" * 25, "\xa9" * 23]),
+           make_tx(["", ""], ["\x00" * 22], [["\x30" * 71], ["\x30" * 72]])]
+    block = make_block(txs)
+    offsets = list(iter_block_tx_offsets(block))
+    assert [block[start:end] for start, end in offsets] == txs
+    assert offsets[-1][1] == len(block)
+
+def test_iter_block_tx_offsets_many_txs():
+    #more than 252 transactions: a 3 byte count varint
+    txs = [make_tx([chr(i % 256)], ["\x51"]) for i in range(300)]
+    block = make_block(txs)
+    offsets = list(iter_block_tx_offsets(block))
+    assert len(offsets) == 300
+    assert offsets[0][0] == 83
+    assert offsets[-1][1] == len(block)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of BlockCache against a fake Bitcoin Core RPC; no bitcoind is
+needed:
+py.test test_blockcache.py
+"""
+import sys
+import os
+import binascii
+import hashlib
+import shutil
+import tempfile
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from coinswap import BlockCache
+
+BLOCK_SIZE = 1000
+
+
+class FakeRPC(object):
+    """A chain of fake blocks, each BLOCK_SIZE bytes with its parent's
+    hash in the header; counts the calls made by method.
+    """
+    def __init__(self, length):
+        self.blocks = {}
+        self.chain = []
+        self.calls = {}
+        self.extend(length)
+
+    def extend(self, n, tag="a"):
+        for _ in range(n):
+            prevhash = self.chain[-1] if self.chain else "00" * 32
+            body = tag + str(len(self.chain))
+            rawblock = "\x01\x00\x00\x00" + binascii.unhexlify(
+                prevhash)[::-1] + body + "\x00" * (BLOCK_SIZE - 36 - len(
+                    body))
+            blockhash = hashlib.sha256(rawblock).hexdigest()
+            self.blocks[blockhash] = rawblock
+            self.chain.append(blockhash)
+
+    def reorg(self, height, n):
+        """Replace the blocks from height, with n new ones.
+        """
+        self.chain = self.chain[:height]
+        self.extend(n, tag="b")
+
+    def call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getblockhash":
+            return self.chain[params[0]]
+        elif method == "getblock":
+            return binascii.hexlify(self.blocks[params[0]])
+        elif method == "getbestblockhash":
+            return self.chain[-1]
+        elif method == "getblockcount":
+            return len(self.chain) - 1
+        raise Exception("Unexpected call: " + method)
+
+
+def test_cached_block_not_fetched_again():
+    rpc = FakeRPC(5)
+    cache = BlockCache(10 * BLOCK_SIZE)
+    first = cache.get_rawblock(3, rpc)
+    assert cache.get_rawblock(3, rpc) == first
+    assert first == rpc.blocks[rpc.chain[3]]
+    assert rpc.calls["getblock"] == 1
+    assert rpc.calls["getblockhash"] == 1
+
+def test_least_recently_used_evicted():
+    rpc = FakeRPC(5)
+    cache = BlockCache(2 * BLOCK_SIZE)
+    cache.get_rawblock(0, rpc)
+    cache.get_rawblock(1, rpc)
+    cache.get_rawblock(0, rpc)
+    cache.get_rawblock(2, rpc)
+    assert cache.size == 2 * BLOCK_SIZE
+    assert rpc.chain[1] not in cache.blocks
+    assert rpc.chain[0] in cache.blocks
+    cache.get_rawblock(0, rpc)
+    assert rpc.calls["getblock"] == 3
+
+def test_block_larger_than_cache_not_kept():
+    rpc = FakeRPC(2)
+    cache = BlockCache(BLOCK_SIZE - 1)
+    cache.get_rawblock(1, rpc)
+    assert cache.size == 0
+    assert not cache.blocks
+
+def test_sync_tip_drops_reorged_heights():
+    rpc = FakeRPC(6)
+    cache = BlockCache(10 * BLOCK_SIZE)
+    cache.sync_tip(rpc)
+    for h in range(6):
+        cache.get_rawblock(h, rpc)
+    rpc.reorg(3, 4)
+    cache.sync_tip(rpc)
+    for h in range(7):
+        assert cache.get_rawblock(h, rpc) == rpc.blocks[rpc.chain[h]]
+    #an unchanged tip costs one call
+    calls = rpc.calls["getbestblockhash"]
+    cache.sync_tip(rpc)
+    assert rpc.calls["getbestblockhash"] == calls + 1
+    assert rpc.calls["getblockcount"] == 2
+
+def test_check_parent_drops_stale_heights():
+    rpc = FakeRPC(4)
+    cache = BlockCache(10 * BLOCK_SIZE)
+    for h in range(3):
+        cache.get_rawblock(h, rpc)
+    #a reorg not seen by sync_tip; block 3's parent is not the cached 2
+    rpc.reorg(2, 2)
+    assert cache.get_rawblock(3, rpc) == rpc.blocks[rpc.chain[3]]
+    assert cache.heights[2] == rpc.chain[2]
+    assert 1 not in cache.heights
+    assert cache.get_rawblock(2, rpc) == rpc.blocks[rpc.chain[2]]
+
+def test_spilled_blocks_survive_restart():
+    spill_dir = tempfile.mkdtemp()
+    try:
+        rpc = FakeRPC(3)
+        cache = BlockCache(10 * BLOCK_SIZE, spill_dir, 10 * BLOCK_SIZE)
+        cache.get_rawblock(2, rpc)
+        restarted = BlockCache(10 * BLOCK_SIZE, spill_dir, 10 * BLOCK_SIZE)
+        assert restarted.get_rawblock(2, rpc) == rpc.blocks[rpc.chain[2]]
+        assert rpc.calls["getblock"] == 1
+    finally:
+        shutil.rmtree(spill_dir)
+
+def test_spill_bounded():
+    spill_dir = tempfile.mkdtemp()
+    try:
+        rpc = FakeRPC(5)
+        cache = BlockCache(10 * BLOCK_SIZE, spill_dir, 3 * BLOCK_SIZE)
+        for h in range(5):
+            cache.get_rawblock(h, rpc)
+        assert len(os.listdir(spill_dir)) == 3
+    finally:
+        shutil.rmtree(spill_dir)
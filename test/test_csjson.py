@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of the server's handling of JSON-RPC requests
+(CoinSwapCarolJSONServer.render, SizeLimitedRequest) and of its cached
+status, with fake requests; no bitcoind is needed:
+py.test test_csjson.py
+"""
+import sys
+import os
+import io
+import json
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from twisted.internet import defer
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest, DummyChannel
+from coinswap import cs_single, CoinSwapCarolJSONServer
+from coinswap.csjson import SizeLimitedRequest
+from commontest import set_config_defaults
+
+
+@pytest.fixture
+def max_request_bytes():
+    set_config_defaults("SERVER", [("max_request_bytes", "100000")])
+    return cs_single().config.getint("SERVER", "max_request_bytes")
+
+class RenderingServer(CoinSwapCarolJSONServer):
+    """Only the attributes used in rendering; no wallet is needed."""
+    def __init__(self, max_request_bytes, methods):
+        self.methods = methods
+        self.max_request_bytes = max_request_bytes
+        self.is_jsonp = False
+        self.callback = None
+
+def make_request(body):
+    request = DummyRequest([""])
+    request.method = "POST"
+    request.content = io.BytesIO(body)
+    return request
+
+def render(server, request):
+    """Returns the response body, whether returned or written."""
+    result = server.render(request)
+    if result != NOT_DONE_YET:
+        return result
+    return "".join(request.written)
+
+def call(method, params, request_id=1):
+    return json.dumps({"jsonrpc": "2.0", "method": method, "params": params,
+                       "id": request_id})
+
+def test_oversized_body_rejected(max_request_bytes):
+    called = []
+    server = RenderingServer(max_request_bytes, {"status": called.append})
+    body = call("status", ["x" * max_request_bytes])
+    request = make_request(body)
+    assert render(server, request) == "Request too large."
+    assert request.responseCode == 413
+    assert not called
+
+def test_flagged_request_rejected(max_request_bytes):
+    server = RenderingServer(max_request_bytes, {})
+    request = make_request(call("status", []))
+    request.too_large = True
+    assert render(server, request) == "Request too large."
+    assert request.responseCode == 413
+
+def test_oversized_body_not_stored(max_request_bytes):
+    request = SizeLimitedRequest(DummyChannel(), False)
+    request.gotLength(None)
+    request.handleContentChunk("x" * max_request_bytes)
+    assert not request.too_large
+    request.handleContentChunk("x")
+    assert request.too_large
+    assert request.content.tell() == 0
+    request = SizeLimitedRequest(DummyChannel(), False)
+    request.gotLength(max_request_bytes + 1)
+    assert request.too_large
+    request.handleContentChunk("x")
+    assert request.content.tell() == 0
+
+def test_dispatched_through_methods(max_request_bytes):
+    calls = []
+    def status(version=None):
+        calls.append(version)
+        return {"version": 2}
+    server = RenderingServer(max_request_bytes, {"status": status})
+    request = make_request(call("status", [1], request_id=7))
+    response = json.loads(render(server, request))
+    assert calls == [1]
+    assert response["result"] == {"version": 2}
+    assert response["id"] == 7
+    assert request.finished
+
+def test_deferred_result(max_request_bytes):
+    d = defer.Deferred()
+    server = RenderingServer(max_request_bytes, {"status": lambda: d})
+    request = make_request(call("status", []))
+    assert server.render(request) == NOT_DONE_YET
+    assert not request.written
+    d.callback(True)
+    assert json.loads("".join(request.written))["result"] is True
+
+def test_unknown_method_fault(max_request_bytes):
+    #e.g. a method of the base class, not in self.methods
+    server = RenderingServer(max_request_bytes, {"status": lambda: True})
+    request = make_request(call("jsonrpc_status", [], request_id=3))
+    response = json.loads(render(server, request))
+    assert response["error"]["code"] == server.NOT_FOUND
+    assert "jsonrpc_status" in response["error"]["message"]
+    assert response["id"] == 3
+    assert "result" not in response or response["result"] is None
+
+def test_error_fault(max_request_bytes):
+    def status():
+        raise ValueError("bad status")
+    server = RenderingServer(max_request_bytes, {"status": status})
+    request = make_request(call("status", [], request_id=4))
+    response = json.loads(render(server, request))
+    assert response["error"]["code"] == server.FAILURE
+    assert response["error"]["message"] == "bad status"
+    assert response["id"] == 4
+
+def test_ill_formed_requests(max_request_bytes):
+    server = RenderingServer(max_request_bytes, {"status": lambda: True})
+    for body in ["", "{not json", json.dumps([1]),
+                 json.dumps({"method": 1}),
+                 json.dumps({"method": "status", "params": "x"})]:
+        request = make_request(body)
+        assert render(server, request) == "Nothing here."
+
+class StatusServer(CoinSwapCarolJSONServer):
+    """Only the status cache; update_status returns a copy of self.data."""
+    def __init__(self, data, max_age=3600):
+        self.data = data
+        self.updates = 0
+        self.carols = {}
+        self.status_data = None
+        self.status = None
+        self.status_version = 0
+        self.status_expiry = 0
+        self.status_max_age = max_age
+
+    def update_status(self):
+        self.updates += 1
+        return dict(self.data)
+
+class FakeCarol(object):
+    completion_callback = None
+
+def test_status_cached():
+    server = StatusServer({"busy": False})
+    status = server.jsonrpc_status()
+    assert status == {"busy": False, "version": 1}
+    assert server.jsonrpc_status() == status
+    assert server.updates == 1
+
+def test_stale_version_updated():
+    server = StatusServer({"busy": False})
+    server.jsonrpc_status()
+    server.data["busy"] = True
+    server.invalidate_status()
+    assert server.jsonrpc_status(1) == {"busy": True, "version": 2}
+    assert server.jsonrpc_status(0) == {"busy": True, "version": 2}
+
+def test_current_version_unchanged():
+    server = StatusServer({"busy": False})
+    server.jsonrpc_status()
+    assert server.jsonrpc_status(1) == {"version": 1, "unchanged": True}
+    #rebuilt but not changed: the version is kept
+    server.invalidate_status()
+    assert server.jsonrpc_status(1) == {"version": 1, "unchanged": True}
+    assert server.updates == 2
+
+def test_expired_status_rebuilt():
+    server = StatusServer({"busy": False}, max_age=0)
+    server.jsonrpc_status()
+    server.data["busy"] = True
+    assert server.jsonrpc_status(1)["busy"] is True
+
+def test_state_changes_invalidate():
+    server = StatusServer({"busy": False})
+    server.jsonrpc_status()
+    #a session starting
+    carol = FakeCarol()
+    server.set_carol(carol, "session")
+    server.jsonrpc_status()
+    assert server.updates == 2
+    #a session finishing
+    carol.completion_callback()
+    server.jsonrpc_status()
+    assert server.updates == 3
+    #a new block
+    server.notify()
+    server.jsonrpc_status()
+    assert server.updates == 4
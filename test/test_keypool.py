@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of KeypairPool; no bitcoind is needed:
+py.test test_keypool.py
+"""
+import sys
+import os
+import time
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import jmbitcoin as btc
+from coinswap import KeypairPool
+
+
+def wait_until_full(pool, timeout=30):
+    deadline = time.time() + timeout
+    while not pool.keypairs.full():
+        assert time.time() < deadline, "Keypair pool not filled"
+        time.sleep(0.01)
+
+def test_take_without_start_generates_keypair():
+    pool = KeypairPool(3)
+    privkey, pubkey = pool.take()
+    assert len(privkey) == 66 and privkey.endswith("01")
+    assert btc.privkey_to_pubkey(privkey) == pubkey
+    assert pool.keypairs.empty()
+
+def test_filled_by_thread_and_stopped():
+    pool = KeypairPool(3)
+    pool.start()
+    try:
+        wait_until_full(pool)
+        assert pool.thread.is_alive()
+    finally:
+        pool.stop()
+    assert not pool.thread.is_alive()
+
+def test_keypairs_handed_out_once():
+    pool = KeypairPool(5)
+    pool.start()
+    try:
+        wait_until_full(pool)
+        keypairs = [pool.take() for _ in range(10)]
+    finally:
+        pool.stop()
+    assert len(set(keypairs)) == 10
+    for privkey, pubkey in keypairs:
+        assert btc.privkey_to_pubkey(privkey) == pubkey
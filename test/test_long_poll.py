@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of Carol's long polled requests (phase2_ready, confirm_tx4);
+no bitcoind is needed:
+py.test test_long_poll.py
+"""
+import sys
+import os
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from twisted.internet import task, defer
+from coinswap import CoinSwapCarol
+import coinswap.carol
+from commontest import set_config_defaults
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    set_config_defaults("TIMEOUT", [("long_poll_timeout", "60")])
+    clock = task.Clock()
+    monkeypatch.setattr(coinswap.carol, "reactor", clock)
+    return clock
+
+def make_carol():
+    #only the long poll attributes are needed
+    carol = CoinSwapCarol.__new__(CoinSwapCarol)
+    carol.long_polls = []
+    carol.phase2_ready = False
+    return carol
+
+def get_result(d):
+    results = []
+    d.addBoth(results.append)
+    assert results
+    return results[0]
+
+def test_answered_immediately(clock):
+    carol = make_carol()
+    carol.phase2_ready = True
+    assert carol.jsonrpc_phase2_ready(30) is True
+    carol.phase2_ready = False
+    #no timeout requested: never held
+    assert carol.jsonrpc_phase2_ready(0) is False
+    assert not carol.long_polls
+
+def test_answered_on_timeout(clock):
+    carol = make_carol()
+    d = carol.jsonrpc_phase2_ready(30)
+    assert isinstance(d, defer.Deferred)
+    clock.advance(29)
+    assert not d.called
+    clock.advance(1)
+    assert get_result(d) is False
+    assert not carol.long_polls
+
+def test_timeout_capped(clock):
+    carol = make_carol()
+    d = carol.jsonrpc_phase2_ready(1000)
+    clock.advance(60)
+    assert get_result(d) is False
+
+def test_answered_when_condition_true(clock):
+    carol = make_carol()
+    d = carol.jsonrpc_phase2_ready(30)
+    carol.update_long_polls()
+    assert not d.called
+    carol.phase2_ready = True
+    carol.update_long_polls()
+    assert get_result(d) is True
+    assert not carol.long_polls
+    assert not clock.getDelayedCalls()
+
+def test_cancelled_poll_dropped(clock):
+    carol = make_carol()
+    d = carol.jsonrpc_phase2_ready(30)
+    #as when the client disconnects
+    d.cancel()
+    assert isinstance(get_result(d).value, defer.CancelledError)
+    assert not carol.long_polls
+    assert not clock.getDelayedCalls()
+
+def test_finished_when_session_ends(clock):
+    carol = make_carol()
+    polls = [carol.jsonrpc_phase2_ready(30) for _ in range(2)]
+    carol.finish_long_polls()
+    assert [get_result(d) for d in polls] == [False, False]
+    assert not carol.long_polls
+    assert not clock.getDelayedCalls()
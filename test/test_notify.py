@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of the chain tip and of the services notified by it, with
+a fake bitcoind; no bitcoind is needed:
+py.test test_notify.py
+"""
+import sys
+import os
+import time
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from twisted.internet import task
+from coinswap import cs_single, PollingPolicy
+from coinswap.notify import ChainTip, HeightScheduler
+import coinswap.notify
+
+
+class FakeRPC(object):
+    def __init__(self, height):
+        self.height = height
+        self.calls = 0
+
+    def call(self, method, params):
+        assert method == "getblockchaininfo"
+        self.calls += 1
+        return {"blocks": self.height,
+                "bestblockhash": "hash" + str(self.height)}
+
+class FakeLoop(object):
+    def reset(self):
+        pass
+
+class FakeBlockchainInterface(object):
+    def __init__(self, rpc):
+        self.jsonRpc = rpc
+
+@pytest.fixture
+def rpc(monkeypatch):
+    rpc = FakeRPC(100)
+    monkeypatch.setattr(cs_single(), "bc_interface",
+                        FakeBlockchainInterface(rpc), raising=False)
+    return rpc
+
+def make_tip(rpc):
+    #not started: no polling loop
+    tip = ChainTip.__new__(ChainTip)
+    tip.height = tip.blockhash = tip.mediantime = tip.updated = None
+    tip.listeners = []
+    tip.rpc = rpc
+    tip.updating = False
+    tip.loop = FakeLoop()
+    return tip
+
+def test_refresh_reads_unread_tip(rpc):
+    tip = make_tip(rpc)
+    tip.refresh(5)
+    assert tip.height == 100 and rpc.calls == 1
+
+def test_refresh_reads_stale_tip(rpc):
+    tip = make_tip(rpc)
+    tip.set_tip(rpc.call("getblockchaininfo", []))
+    rpc.height = 101
+    tip.updated = time.time() - 30
+    tip.refresh(5)
+    assert tip.height == 101 and rpc.calls == 2
+
+def test_refresh_keeps_recent_tip(rpc):
+    tip = make_tip(rpc)
+    tip.set_tip(rpc.call("getblockchaininfo", []))
+    rpc.height = 101
+    tip.refresh(5)
+    assert tip.height == 100 and rpc.calls == 1
+
+class FakeTip(object):
+    def __init__(self, height):
+        self.height = height
+
+@pytest.fixture
+def chain(monkeypatch):
+    """The fake tip; set its height, then notify() the scheduler as
+    ChainTip would, and advance the clock.
+    """
+    clock = task.Clock()
+    tip = FakeTip(100)
+    monkeypatch.setattr(coinswap.notify, "reactor", clock)
+    monkeypatch.setattr(coinswap.notify, "get_chain_tip", lambda: tip)
+    tip.clock = clock
+    return tip
+
+def make_scheduler():
+    return HeightScheduler(policy=PollingPolicy(60, 60, 1))
+
+def move_tip(chain, scheduler, height):
+    chain.height = height
+    scheduler.notify()
+    chain.clock.advance(0)
+
+def test_called_at_height(chain):
+    scheduler = make_scheduler()
+    called = []
+    scheduler.call_at_height(102, called.append, "a")
+    chain.clock.advance(0)
+    assert not called
+    move_tip(chain, scheduler, 101)
+    assert not called
+    move_tip(chain, scheduler, 102)
+    assert called == ["a"]
+    move_tip(chain, scheduler, 103)
+    assert called == ["a"]
+    #no waiters: no polling
+    assert not scheduler.loop.running
+
+def test_called_after_height(chain):
+    scheduler = make_scheduler()
+    called = []
+    scheduler.call_at_height(90, called.append, "a")
+    chain.clock.advance(0)
+    assert called == ["a"]
+    scheduler.call_at_height(101, called.append, "b")
+    #e.g. a notification lost: the fallback poll sees the new tip
+    chain.height = 105
+    chain.clock.advance(60)
+    assert called == ["a", "b"]
+
+def test_called_in_height_order(chain):
+    scheduler = make_scheduler()
+    called = []
+    scheduler.call_at_height(103, called.append, "b")
+    scheduler.call_at_height(102, called.append, "a")
+    scheduler.call_at_height(104, called.append, "c")
+    move_tip(chain, scheduler, 103)
+    assert called == ["a", "b"]
+
+def test_cancel(chain):
+    scheduler = make_scheduler()
+    called = []
+    waiter_id = scheduler.call_at_height(102, called.append, "a")
+    scheduler.call_at_height(102, called.append, "b")
+    scheduler.cancel(waiter_id)
+    move_tip(chain, scheduler, 102)
+    assert called == ["b"]
+
+def test_reorg_to_lower_height(chain):
+    scheduler = make_scheduler()
+    called = []
+    move_tip(chain, scheduler, 101)
+    scheduler.call_at_height(102, called.append, "a")
+    move_tip(chain, scheduler, 99)
+    assert not called
+    assert scheduler.waiters
+    move_tip(chain, scheduler, 101)
+    assert not called
+    move_tip(chain, scheduler, 102)
+    assert called == ["a"]
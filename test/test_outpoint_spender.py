@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of find_outpoint_spender against a fake Bitcoin Core wallet RPC;
+no bitcoind is needed:
+py.test test_outpoint_spender.py
+"""
+import sys
+import os
+import binascii
+import struct
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from coinswap import find_outpoint_spender
+import coinswap.scanner
+
+TX3_TXID = "33" * 32
+
+
+def make_spend(txid, n):
+    """A serialized (hex) transaction with one input, spending txid:n,
+    and one output.
+    """
+    tx = struct.pack("<I", 2) + "\x01" + binascii.unhexlify(txid)[::-1] + \
+         struct.pack("<I", n) + "\x00" + "\xff" * 4
+    tx += "\x01" + struct.pack("<Q", 1000) + "\x01\x51" + struct.pack("<I", 0)
+    return binascii.hexlify(tx)
+
+class FakeRPC(object):
+    def __init__(self, entries, transactions, unspent=False):
+        #oldest first, as listtransactions returns them
+        self.entries = entries
+        self.transactions = transactions
+        self.unspent = unspent
+        self.fetched = []
+
+    def call(self, method, params):
+        if method == "gettxout":
+            return {"value": 1} if self.unspent else None
+        elif method == "listtransactions":
+            return self.entries[-params[1]:]
+        elif method == "gettransaction":
+            self.fetched.append(params[0])
+            return {"hex": self.transactions[params[0]]}
+        raise Exception("Unexpected call: " + method)
+
+def entry(txid, category, watchonly=True):
+    e = {"txid": txid, "category": category}
+    if watchonly:
+        e["involvesWatchonly"] = True
+    return e
+
+@pytest.fixture
+def wallet(monkeypatch):
+    transactions = {"aa" * 32: make_spend("11" * 32, 0),
+                    "bb" * 32: make_spend(TX3_TXID, 0),
+                    "cc" * 32: make_spend("22" * 32, 1),
+                    "dd" * 32: make_spend("44" * 32, 0)}
+    entries = [entry("aa" * 32, "send"),
+               entry(TX3_TXID, "receive"),
+               entry("ee" * 32, "receive"),
+               entry("bb" * 32, "send"),
+               entry("ff" * 32, "receive", watchonly=False),
+               entry("cc" * 32, "receive"),
+               entry("cc" * 32, "send"),
+               entry("dd" * 32, "send", watchonly=False)]
+    rpc = FakeRPC(entries, transactions)
+    monkeypatch.setattr(coinswap.scanner, "get_thread_rpc", lambda: rpc)
+    return rpc
+
+def test_unspent(wallet):
+    wallet.unspent = True
+    assert find_outpoint_spender(TX3_TXID + ":0") is None
+    assert not wallet.fetched
+
+def test_spend_found(wallet):
+    assert find_outpoint_spender(TX3_TXID + ":0") == \
+           wallet.transactions["bb" * 32]
+    #only watch-only sends are fetched, once each
+    assert wallet.fetched == ["cc" * 32, "bb" * 32]
+
+def test_not_looked_for_before_spent_tx(wallet):
+    assert find_outpoint_spender(TX3_TXID + ":1") is None
+    #sends older than TX3 are not candidates
+    assert wallet.fetched == ["cc" * 32, "bb" * 32]
+
+def test_count_bounds_candidates(wallet):
+    assert find_outpoint_spender(TX3_TXID + ":0", count=3) is None
+    assert wallet.fetched == ["cc" * 32]
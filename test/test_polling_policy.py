@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of PollingPolicy; no bitcoind is needed:
+py.test test_polling_policy.py
+"""
+import sys
+import os
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from coinswap import PollingPolicy
+
+
+def test_backs_off_to_max_interval():
+    policy = PollingPolicy(2.0, 30.0, 2.0)
+    intervals = [policy.next_interval() for _ in range(6)]
+    assert intervals == [2.0, 4.0, 8.0, 16.0, 30.0, 30.0]
+
+def test_reset_returns_to_min_interval():
+    policy = PollingPolicy(2.0, 30.0, 2.0)
+    for _ in range(4):
+        policy.next_interval()
+    policy.reset()
+    assert policy.next_interval() == 2.0
+    assert policy.next_interval() == 4.0
+
+def test_no_backoff():
+    policy = PollingPolicy(5.0, 60.0, 1.0)
+    assert [policy.next_interval() for _ in range(3)] == [5.0, 5.0, 5.0]
+
+def test_max_interval_below_min_interval():
+    policy = PollingPolicy(10.0, 5.0, 2.0)
+    assert [policy.next_interval() for _ in range(3)] == [10.0, 10.0, 10.0]
+
+def test_deadline_shortens_interval():
+    policy = PollingPolicy(2.0, 60.0, 2.0)
+    for _ in range(5):
+        policy.next_interval()
+    #backed off to 60s, but a deadline 100s away allows only 10s
+    assert policy.next_interval(100.0) == 10.0
+    #never below min_interval, even with the deadline passed
+    assert policy.next_interval(5.0) == 2.0
+    assert policy.next_interval(-1.0) == 2.0
+    #a distant deadline does not lengthen it
+    assert policy.next_interval(10000.0) == 60.0
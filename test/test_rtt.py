@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of RTTEstimator and RTTSampleFile; no bitcoind is needed:
+py.test test_rtt.py
+"""
+import sys
+import os
+import shutil
+import tempfile
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from coinswap import cs_single, RTTEstimator, RTTSampleFile
+from coinswap.rtt import RTT_WINDOW
+
+#the defaults in the TIMEOUT section of the config
+TIMEOUT_DEFAULTS = [("default_network_timeout", "60"),
+                    ("network_timeout_percentile", "95"),
+                    ("network_timeout_factor", "3"),
+                    ("network_timeout_floor", "20"),
+                    ("network_timeout_ceiling", "180")]
+
+
+def setup_module(module):
+    #the config is only loaded for the tests run against bitcoind
+    c = cs_single().config
+    if not c.has_section("TIMEOUT"):
+        c.add_section("TIMEOUT")
+    for option, value in TIMEOUT_DEFAULTS:
+        if not c.has_option("TIMEOUT", option):
+            c.set("TIMEOUT", option, value)
+
+def test_default_timeout_until_enough_samples():
+    assert RTTEstimator("a", [1.0] * 4).get_timeout() == 60.0
+
+def test_timeout_from_percentile():
+    #the 95th percentile of 20 samples is the highest
+    estimator = RTTEstimator("a", [10.0] * 19 + [40.0])
+    assert estimator.get_timeout() == 120.0
+
+def test_timeout_bounded():
+    assert RTTEstimator("a", [1.0] * 10).get_timeout() == 20.0
+    assert RTTEstimator("a", [100.0] * 10).get_timeout() == 180.0
+
+def test_only_recent_samples_kept():
+    estimator = RTTEstimator("a", [100.0] * RTT_WINDOW + [10.0] * 10)
+    assert len(estimator.samples) == RTT_WINDOW
+    estimator = RTTEstimator("a", [10.0] * RTT_WINDOW + [100.0] * 10)
+    assert estimator.percentile(50) == 10.0
+
+def test_sample_files_merged():
+    homedir = tempfile.mkdtemp()
+    try:
+        location = os.path.join(homedir, "rtt_samples.json")
+        #e.g. a server and a client sharing the home directory
+        RTTSampleFile(location).write({"onion": [1.0, 2.0]})
+        RTTSampleFile(location).write({"example.onion:80": [3.0]})
+        client = RTTSampleFile(location)
+        client.write({"example.onion:80": [3.0, 4.0]})
+        assert client.load() == {"onion": [1.0, 2.0],
+                                 "example.onion:80": [3.0, 4.0]}
+        assert os.listdir(homedir) == ["rtt_samples.json"]
+    finally:
+        shutil.rmtree(homedir)
+
+def test_missing_or_corrupt_sample_file():
+    homedir = tempfile.mkdtemp()
+    try:
+        location = os.path.join(homedir, "rtt_samples.json")
+        assert RTTSampleFile(location).load() == {}
+        with open(location, "wb") as f:
+            f.write("{not json")
+        assert RTTSampleFile(location).load() == {}
+    finally:
+        shutil.rmtree(homedir)
+
+def test_saves_debounced():
+    sample_file = RTTSampleFile(os.path.join(tempfile.gettempdir(),
+                                             "rtt_samples.json"))
+    sample_file.schedule_save()
+    save_call = sample_file.save_call
+    sample_file.schedule_save()
+    sample_file.schedule_save()
+    assert sample_file.save_call is save_call
+    save_call.cancel()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of SecretScanCoordinator's merging of scan requests, with
+a fake scanner; no bitcoind is needed:
+py.test test_scan_coordinator.py
+"""
+import sys
+import os
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from twisted.internet import task, defer
+from coinswap import SecretScanCoordinator
+import coinswap.scanner
+
+
+class FakeScanner(object):
+    """Records each scan started; the test fires it with finish()."""
+    def __init__(self, wanted, progress_callback=None):
+        self.wanted = wanted
+        self.parsed = set()
+        self.progress_callback = progress_callback
+        self.d = defer.Deferred()
+        FakeScanner.scans.append(self)
+
+    def scan(self):
+        pass
+
+    def finish(self, secrets, parsed=()):
+        self.parsed = set(parsed)
+        self.d.callback(secrets)
+
+class FakeThreads(object):
+    @staticmethod
+    def deferToThread(f, *args):
+        #f is the bound scan method of a FakeScanner
+        return f.__self__.d
+
+@pytest.fixture
+def clock(monkeypatch):
+    FakeScanner.scans = []
+    clock = task.Clock()
+    monkeypatch.setattr(coinswap.scanner, "reactor", clock)
+    monkeypatch.setattr(coinswap.scanner, "threads", FakeThreads)
+    monkeypatch.setattr(coinswap.scanner, "SecretScanner", FakeScanner)
+    return clock
+
+def results(d):
+    r = []
+    d.addCallback(r.append)
+    return r
+
+def test_requests_together_share_a_scan(clock):
+    coordinator = SecretScanCoordinator()
+    r1 = results(coordinator.request("h1", [(100, 110)]))
+    r2 = results(coordinator.request("h2", [(105, 120)]))
+    clock.advance(0)
+    assert len(FakeScanner.scans) == 1
+    assert FakeScanner.scans[0].wanted == {"h1": [(100, 110)],
+                                           "h2": [(105, 120)]}
+    FakeScanner.scans[0].finish({"h2": "p2"})
+    assert r1 == [None] and r2 == ["p2"]
+
+def test_request_during_scan_queued(clock):
+    coordinator = SecretScanCoordinator()
+    r1 = results(coordinator.request("h1", [(100, 110)]))
+    clock.advance(0)
+    r2 = results(coordinator.request("h2", [(100, 110)]))
+    r3 = results(coordinator.request("h3", [(90, 100)]))
+    clock.advance(0)
+    #no second scan in parallel with the first
+    assert len(FakeScanner.scans) == 1
+    FakeScanner.scans[0].finish({"h1": "p1"})
+    assert r1 == ["p1"] and not r2 and not r3
+    clock.advance(0)
+    #the queued requests are run in one scan
+    assert len(FakeScanner.scans) == 2
+    assert FakeScanner.scans[1].wanted == {"h2": [(100, 110)],
+                                           "h3": [(90, 100)]}
+    FakeScanner.scans[1].finish({"h3": "p3"})
+    assert r2 == [None] and r3 == ["p3"]
+    clock.advance(0)
+    assert len(FakeScanner.scans) == 2
+
+def test_request_covered_by_running_scan_joins_it(clock):
+    coordinator = SecretScanCoordinator()
+    progress = []
+    r1 = results(coordinator.request("h1", [(100, 110)]))
+    clock.advance(0)
+    r2 = results(coordinator.request("h1", [(102, 108)], progress.append))
+    FakeScanner.scans[0].finish({"h1": "p1"}, parsed=range(100, 111))
+    clock.advance(0)
+    assert len(FakeScanner.scans) == 1
+    assert r1 == ["p1"] and r2 == ["p1"]
+    assert progress == [set(range(100, 111))]
+
+def test_request_beyond_running_scan_queued(clock):
+    coordinator = SecretScanCoordinator()
+    coordinator.request("h1", [(100, 110)])
+    clock.advance(0)
+    r2 = results(coordinator.request("h1", [(100, 120)]))
+    FakeScanner.scans[0].finish({})
+    clock.advance(0)
+    assert len(FakeScanner.scans) == 2
+    assert FakeScanner.scans[1].wanted == {"h1": [(100, 120)]}
+    FakeScanner.scans[1].finish({"h1": "p1"})
+    assert r2 == ["p1"]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of the record of heights Carol has scanned for the secret
+(get_unscanned_ranges, record_scan_progress); no bitcoind is needed:
+py.test test_scan_progress.py
+"""
+import sys
+import os
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from coinswap import CoinSwapCarol
+
+
+def make_carol(covered=None):
+    #only the scan progress attributes are needed
+    carol = CoinSwapCarol.__new__(CoinSwapCarol)
+    carol.secret_scan_covered = covered
+    carol.persisted = 0
+    def persist():
+        carol.persisted += 1
+    carol.persist = persist
+    return carol
+
+def test_nothing_scanned():
+    carol = make_carol()
+    assert carol.get_unscanned_ranges(100, 110) == [(100, 110)]
+    assert carol.get_unscanned_ranges(111, 110) == []
+
+def test_partial_overlap():
+    carol = make_carol([95, 104])
+    assert carol.get_unscanned_ranges(100, 110) == [(105, 110)]
+    carol = make_carol([105, 120])
+    assert carol.get_unscanned_ranges(100, 110) == [(100, 104)]
+    carol = make_carol([103, 106])
+    assert carol.get_unscanned_ranges(100, 110) == [(107, 110), (100, 102)]
+
+def test_adjacent_ranges():
+    carol = make_carol([111, 120])
+    assert carol.get_unscanned_ranges(100, 110) == [(100, 110)]
+    carol = make_carol([90, 99])
+    assert carol.get_unscanned_ranges(100, 110) == [(100, 110)]
+
+def test_full_coverage():
+    carol = make_carol([100, 110])
+    assert carol.get_unscanned_ranges(100, 110) == []
+    carol = make_carol([90, 120])
+    assert carol.get_unscanned_ranges(100, 110) == []
+
+def test_progress_starts_from_highest():
+    carol = make_carol()
+    ranges = [(100, 110)]
+    #the highest height of the ranges is not yet scanned
+    carol.record_scan_progress([105, 106], ranges)
+    assert carol.secret_scan_covered is None
+    assert not carol.persisted
+    carol.record_scan_progress(range(106, 111), ranges)
+    assert carol.secret_scan_covered == [106, 110]
+    assert carol.persisted == 1
+
+def test_progress_extends_contiguously():
+    carol = make_carol([106, 110])
+    ranges = carol.get_unscanned_ranges(100, 115)
+    assert ranges == [(111, 115), (100, 105)]
+    #a gap at 104 stops the extension downwards
+    carol.record_scan_progress([105, 103, 111, 112], ranges)
+    assert carol.secret_scan_covered == [105, 112]
+    #the heights scanned so far are passed each time
+    carol.record_scan_progress([105, 103, 111, 112, 104], ranges)
+    assert carol.secret_scan_covered == [103, 112]
+    assert carol.persisted == 2
+    #nothing new: not persisted again
+    carol.record_scan_progress([105, 103, 111, 112, 104], ranges)
+    assert carol.persisted == 2
+
+def test_progress_outside_ranges_ignored():
+    #e.g. heights scanned for another session sharing the scan
+    carol = make_carol([106, 110])
+    carol.record_scan_progress([111, 112], [(100, 105)])
+    assert carol.secret_scan_covered == [106, 110]
+    assert not carol.persisted
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of SecretIndex and of applying blocks to it with a
+SecretIndexFollower; no bitcoind is needed:
+py.test test_secret_index.py
+"""
+import sys
+import os
+import shutil
+import tempfile
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+import pytest
+from coinswap import SecretIndex, SecretIndexFollower
+
+
+@pytest.fixture
+def location():
+    homedir = tempfile.mkdtemp()
+    yield os.path.join(homedir, "secretindex.json")
+    shutil.rmtree(homedir)
+
+def block_hash(height, branch="a"):
+    return branch + str(height)
+
+def make_index(location, start, tip, branch="a"):
+    """An index of blocks start to tip, with a secret in each."""
+    index = SecretIndex(location)
+    for h in range(start, tip + 1):
+        index.add_block(h, block_hash(h, branch),
+                        {"hash" + str(h): "preimage" + str(h)})
+    return index
+
+def test_add_block_and_covers(location):
+    index = SecretIndex(location)
+    assert not index.covers(100)
+    index = make_index(location, 100, 105)
+    assert index.start_height == 100 and index.tip_height == 105
+    assert [index.covers(h) for h in [99, 100, 105, 106]] == [
+        False, True, True, False]
+    assert index.lookup("hash103") == "preimage103"
+    assert index.lookup("hash99") is None
+    assert index.get_tip_hash() == block_hash(105)
+
+def test_add_block_out_of_order(location):
+    index = make_index(location, 100, 105)
+    with pytest.raises(AssertionError):
+        index.add_block(107, block_hash(107), {})
+
+def test_rewind(location):
+    index = make_index(location, 100, 105)
+    index.rewind()
+    index.rewind()
+    assert index.tip_height == 103
+    assert index.get_tip_hash() == block_hash(103)
+    assert index.lookup("hash104") is None
+    assert index.lookup("hash103") == "preimage103"
+    assert not index.covers(104)
+
+def test_rewind_past_start_rebuilds(location):
+    index = make_index(location, 100, 101)
+    index.rewind()
+    index.rewind()
+    assert index.tip_height is None and index.start_height is None
+    assert not index.preimages
+    assert not index.covers(100)
+
+def test_rewind_beyond_reorg_depth_rebuilds(location):
+    index = make_index(location, 100, 100 + SecretIndex.reorg_depth + 1)
+    #hashes are only kept for the last reorg_depth blocks
+    for _ in range(SecretIndex.reorg_depth - 1):
+        index.rewind()
+    assert index.tip_height == 102
+    index.rewind()
+    assert index.tip_height is None
+
+def test_persisted_and_loaded(location):
+    index = make_index(location, 100, 105)
+    index.persist()
+    loaded = SecretIndex(location)
+    assert (loaded.start_height, loaded.tip_height) == (100, 105)
+    assert loaded.preimages == index.preimages
+    assert loaded.recent_hashes == index.recent_hashes
+    assert loaded.lookup("hash105") == "preimage105"
+    assert not os.path.exists(location + ".tmp")
+
+def make_follower(index):
+    follower = SecretIndexFollower(index, 10)
+    #record the further updates apply_blocks asks for
+    follower.updates = []
+    follower.update = lambda: follower.updates.append(index.tip_height)
+    return follower
+
+def test_follower_applies_blocks(location):
+    index = make_index(location, 100, 102)
+    follower = make_follower(index)
+    caught_up = []
+    follower.when_caught_up().addCallback(caught_up.append)
+    follower.apply_blocks((104, [(103, block_hash(103), block_hash(102), {}),
+                                 (104, block_hash(104), block_hash(103),
+                                  {"hash": "preimage"})]))
+    assert index.tip_height == 104
+    assert index.lookup("hash") == "preimage"
+    assert caught_up == [104]
+    assert not follower.updates
+    assert SecretIndex(location).tip_height == 104
+
+def test_follower_continues_until_tip(location):
+    index = make_index(location, 100, 102)
+    follower = make_follower(index)
+    caught_up = []
+    follower.when_caught_up().addCallback(caught_up.append)
+    follower.apply_blocks((200, [(103, block_hash(103), block_hash(102), {})]))
+    assert follower.updates == [103]
+    assert not caught_up
+
+def test_follower_rewinds_on_reorg(location):
+    index = make_index(location, 100, 105)
+    follower = make_follower(index)
+    #block 106 of another branch, whose parent is not our 105
+    follower.apply_blocks((106, [(106, block_hash(106, "b"),
+                                  block_hash(105, "b"), {})]))
+    assert index.tip_height == 104
+    assert index.lookup("hash105") is None
+    assert follower.updates == [104]
+    #the next update adds the other branch from 105
+    follower.apply_blocks((106, [(105, block_hash(105, "b"), block_hash(104),
+                                  {}),
+                                 (106, block_hash(106, "b"),
+                                  block_hash(105, "b"), {})]))
+    assert index.tip_height == 106
+    assert index.get_tip_hash() == block_hash(106, "b")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of finding coinswap secrets in raw blocks by byte search;
+no bitcoind is needed:
+py.test test_secret_prefilter.py
+"""
+import sys
+import os
+import binascii
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from coinswap import (find_preimages_in_rawblock, get_coinswap_secret,
+                      generate_escrow_redeem_script,
+                      COINSWAP_SECRET_ENTROPY_BYTES)
+
+RECIPIENT_PUBKEY = "02" + "11" * 32
+REFUND_PUBKEY = "03" + "22" * 32
+#some bytes either side of a scriptSig, standing in for the rest of a block
+PADDING = "\x00" * 100 + "\xff" * 100
+
+
+def make_redeem_script(hashed_secret):
+    return generate_escrow_redeem_script(hashed_secret, RECIPIENT_PUBKEY,
+                                         500000, REFUND_PUBKEY)
+
+def make_scriptsig(redeem_script, secret_push):
+    """The scriptSig of a spend of an escrow output: a signature, then
+    secret_push (the secret, or an empty push in a timeout redeem),
+    then the redeem script.
+    """
+    return "\x47" + "\x30" * 71 + secret_push + "\x4c" + chr(
+        len(redeem_script)) + redeem_script
+
+def secret_push(secret):
+    return chr(COINSWAP_SECRET_ENTROPY_BYTES) + binascii.unhexlify(secret)
+
+def test_secret_redeem_found():
+    secret, hashed_secret = get_coinswap_secret()
+    rawblock = PADDING + make_scriptsig(make_redeem_script(hashed_secret),
+                                        secret_push(secret)) + PADDING
+    assert find_preimages_in_rawblock(rawblock) == {hashed_secret: secret}
+
+def test_several_secrets_found():
+    secrets = [get_coinswap_secret() for _ in range(3)]
+    rawblock = PADDING.join([make_scriptsig(make_redeem_script(h),
+                                            secret_push(s))
+                             for s, h in secrets])
+    assert find_preimages_in_rawblock(rawblock) == dict(
+        [(h, s) for s, h in secrets])
+
+def test_timeout_redeem_ignored():
+    secret, hashed_secret = get_coinswap_secret()
+    rawblock = PADDING + make_scriptsig(make_redeem_script(hashed_secret),
+                                        "\x00") + PADDING
+    assert find_preimages_in_rawblock(rawblock) == {}
+
+def test_wrong_preimage_ignored():
+    secret, hashed_secret = get_coinswap_secret()
+    other_secret, other_hashed_secret = get_coinswap_secret()
+    rawblock = PADDING + make_scriptsig(make_redeem_script(hashed_secret),
+                                        secret_push(other_secret)) + PADDING
+    assert find_preimages_in_rawblock(rawblock) == {}
+
+def test_block_without_escrow_spends():
+    assert find_preimages_in_rawblock(PADDING * 10) == {}
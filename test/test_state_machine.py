@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from __future__ import print_function
+"""Tests of the StateMachine alone; no bitcoind is needed:
+py.test test_state_machine.py
+"""
+import sys
+import os
+data_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(data_dir))
+
+from twisted.internet import defer
+from coinswap import StateMachine
+from bad_state_machine import BadStateMachine
+
+
+def make_callbackdata(ran, auto_continue):
+    """Four states; each callback records that it ran.
+    """
+    def make_callback(i):
+        def callback(*args):
+            ran.append(i)
+            return (True, "state " + str(i) + " done")
+        return callback
+    return [(make_callback(i), i in auto_continue, -1) for i in range(4)]
+
+def test_auto_continue_states_run_in_one_tick():
+    ran = []
+    sm = StateMachine(0, lambda msg: None, make_callbackdata(ran, [1, 2]), 20.0)
+    assert sm.tick()[0]
+    assert ran == [0, 1, 2]
+    assert sm.state == 3
+    assert not sm.state_in_process
+    assert [t["state"] for t in sm.get_trace()] == [0, 1, 2]
+    sm.cancel_stall_monitor()
+
+def test_failure_injected_at_auto_continue_state():
+    ran = []
+    injected = []
+    sm = BadStateMachine(0, lambda msg: None, make_callbackdata(ran, [1, 2]),
+                         (2, lambda: injected.append(True)))
+    retval, msg = sm.tick()
+    assert not retval
+    #state 2 is only reached by auto_continue, and must not have run
+    assert ran == [0, 1]
+    assert injected == [True]
+    assert sm.state == 2
+    assert sm.freeze
+    sm.cancel_stall_monitor()
+
+def test_deferred_callback_holds_lock():
+    ran = []
+    d = defer.Deferred()
+    callbackdata = make_callbackdata(ran, [2])
+    callbackdata[1] = (lambda: d, False, -1)
+    sm = StateMachine(0, lambda msg: None, callbackdata, 20.0)
+    sm.tick()
+    result = sm.tick()
+    assert isinstance(result, defer.Deferred)
+    assert sm.state == 1
+    #a further tick while the Deferred is pending is refused
+    assert not sm.tick()[0]
+    d.callback((True, "state 1 done"))
+    assert sm.state == 3
+    assert not sm.state_in_process
+    assert ran == [0, 2]
+    sm.cancel_stall_monitor()
+
+def test_late_deferred_result_dropped_after_freeze():
+    ran = []
+    finalized = []
+    d = defer.Deferred()
+    callbackdata = make_callbackdata(ran, [2])
+    callbackdata[1] = (lambda: d, False, -1)
+    sm = StateMachine(0, lambda msg: None, callbackdata, 20.0)
+    sm.set_finalize(lambda: finalized.append(sm.state))
+    sm.tick()
+    sm.tick()
+    #e.g. the stall monitor fired and the session backed out
+    sm.freeze = True
+    sm.cancel_stall_monitor()
+    d.callback((True, "state 1 done"))
+    assert sm.state == 1
+    assert ran == [0]
+    assert finalized == []
+    assert sm.stall_monitor is None
+    assert [t["state"] for t in sm.get_trace()] == [0]